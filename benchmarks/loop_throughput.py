@@ -0,0 +1,91 @@
+# coding=utf-8
+"""
+End-to-end line throughput of the bot under each available event loop
+
+A local server streams IRC lines to a real Conn over TCP and measures the time
+until the bot has answered a PING sent after the last line.
+
+Usage: python -m benchmarks.loop_throughput [line count]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from bncbot import bot
+from bncbot.async_util import LOOP_POLICIES, set_loop_policy
+from bncbot.conn import Conn
+
+DEFAULT_LINES = 50000
+
+LINES = (
+    b":someone!user@host PRIVMSG #channel :just chatting about things\r\n",
+    b":*status!znc@znc.in PRIVMSG bnc :| someuser | 1 | 0 |\r\n",
+    b":other!user@host NOTICE bnc :hello there\r\n",
+    b":someone!user@host PRIVMSG #channel :.unknowncommand with args\r\n",
+)
+
+
+async def bench(count: int) -> float:
+    done = asyncio.get_running_loop().create_future()
+    timing = {}
+
+    async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Wait for registration to finish before sending the traffic
+        while not (await reader.readline()).startswith(b"USER"):
+            pass
+
+        timing['start'] = time.perf_counter()
+        batch = b"".join(LINES[i % len(LINES)] for i in range(count))
+        writer.write(batch + b":irc.znc.in PING :done\r\n")
+        await writer.drain()
+        while True:
+            line = await reader.readline()
+            if not line or b"done" in line:
+                break
+
+        timing['end'] = time.perf_counter()
+        done.set_result(None)
+        writer.close()
+
+    server = await asyncio.start_server(handle_client, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    conn = Conn(bot.HANDLERS)
+    conn.config = {'server': '127.0.0.1', 'port': port, 'pass': '', 'user': 'bench'}
+    conn.logger.disabled = True
+    conn.loop = asyncio.get_running_loop()
+    await conn.connect()
+    await done
+    conn.close()
+    conn.audit.close()
+    server.close()
+    await server.wait_closed()
+    return timing['end'] - timing['start']
+
+
+def run_child(name: str, count: int) -> None:
+    if set_loop_policy(name) != name:
+        print(f"{name:>8}: unavailable")
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        elapsed = asyncio.run(bench(count))
+
+    print(f"{name:>8}: {count} lines in {elapsed:.3f}s ({count / elapsed:,.0f} lines/s)")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_LINES
+    if len(sys.argv) > 2:
+        run_child(sys.argv[2], count)
+        return
+
+    # Each loop is measured in a fresh process so policies don't leak between runs
+    for name in LOOP_POLICIES:
+        os.spawnv(os.P_WAIT, sys.executable, [sys.executable, '-m', 'benchmarks.loop_throughput', str(count), name])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+# coding=utf-8
+"""
+Compare the memory used by a plain dict of username -> bindhost strings and a UserTable
+
+Usage: python -m benchmarks.usertable_memory [count ...]
+"""
+import gc
+import sys
+import time
+import tracemalloc
+from ipaddress import ip_network
+
+from bncbot.usertable import UserTable
+
+DEFAULT_COUNTS = (100000, 1000000)
+
+
+def make_users(count: int):
+    net = ip_network("10.0.0.0/8")
+    for i in range(count):
+        yield f"user{i}", str(net[i + 1])
+
+
+def measure(count: int, factory):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    table = factory(make_users(count))
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del table
+    gc.collect()
+    return size, elapsed
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or DEFAULT_COUNTS
+    for count in counts:
+        for name, factory in (("dict", dict), ("UserTable", UserTable)):
+            size, elapsed = measure(count, factory)
+            print(f"{name:>9} {count:>8} users: {size / 1024 / 1024:8.1f} MiB, "
+                  f"{size / count:6.1f} B/user, built in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
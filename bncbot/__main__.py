@@ -16,28 +16,37 @@ if path0 == install_dir:
 os.chdir(path0)
 
 from bncbot import bot
+from bncbot.async_util import set_loop_policy
 from bncbot.conn import Conn
 
 
+async def run(conn: Conn) -> bool:
+    loop = asyncio.get_running_loop()
+
+    def handle_sig(sig):
+        if sig == signal.SIGINT:
+            loop.create_task(conn.shutdown())
+            # A second SIGINT will interrupt the bot immediately
+            loop.remove_signal_handler(signal.SIGINT)
+        elif sig == signal.SIGHUP:
+            loop.create_task(conn.shutdown(True))
+
+    for sig in (signal.SIGINT, signal.SIGHUP):
+        loop.add_signal_handler(sig, handle_sig, sig)
+
+    return await conn.run()
+
+
 def main():
     with open('.bncbot.pid', 'w') as pid_file:
         pid_file.write(str(os.getpid()))
     conn = Conn(bot.HANDLERS)
+    conn.load_config()
+    loop_name = conn.config.get('event_loop', 'asyncio')
+    if set_loop_policy(loop_name) != loop_name:
+        conn.logger.warning("Event loop '%s' is unavailable, using asyncio", loop_name)
 
-    original_sigint = signal.getsignal(signal.SIGINT)
-
-    def handle_sig(sig, frame):
-        if sig == signal.SIGINT:
-            if conn:
-                asyncio.run_coroutine_threadsafe(conn.shutdown(), conn.loop)
-            signal.signal(signal.SIGINT, original_sigint)
-        elif sig == signal.SIGHUP:
-            if conn:
-                asyncio.run_coroutine_threadsafe(conn.shutdown(True), conn.loop)
-
-    signal.signal(signal.SIGINT, handle_sig)
-    signal.signal(signal.SIGHUP, handle_sig)
-    restart = conn.run()
+    restart = asyncio.run(run(conn))
     if restart:
         conn = None
         time.sleep(1)
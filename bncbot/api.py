@@ -0,0 +1,157 @@
+# coding=utf-8
+"""
+Local read-only query API served over a Unix socket
+
+Clients send one JSON object per line and get one JSON object per line back:
+
+    {"op": "user", "name": "someuser"}
+    {"ok": true, "result": {"name": "someuser", "bindhost": "127.0.1.2"}}
+
+Supported ops: user, host, queue, status
+"""
+import asyncio
+import json
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from bncbot.conn import Conn
+
+# Clients idle for longer than this are disconnected
+CLIENT_TIMEOUT = 60
+
+# Maximum size of a single request line
+MAX_REQUEST = 4096
+
+
+class ApiError(Exception):
+    pass
+
+
+class QueryServer:
+    def __init__(self, conn: 'Conn', path: Path) -> None:
+        self.conn = conn
+        self.path = path
+        self.requests = 0
+        self.clients = 0
+        self._server = None
+        self.ops: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+            'user': self.op_user,
+            'host': self.op_host,
+            'queue': self.op_queue,
+            'status': self.op_status,
+        }
+
+    async def start(self) -> None:
+        if self.path.is_socket():
+            # Left over from an unclean shutdown
+            self.path.unlink()
+
+        self._server = await asyncio.start_unix_server(self.handle_client, path=str(self.path), limit=MAX_REQUEST)
+        self.path.chmod(0o660)
+
+    async def stop(self) -> None:
+        if self._server is None:
+            return
+
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+        if self.path.is_socket():
+            self.path.unlink()
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.clients += 1
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), CLIENT_TIMEOUT)
+                except (asyncio.TimeoutError, ValueError):
+                    # Idle client, or a request line over the size limit
+                    break
+
+                if not line:
+                    break
+
+                writer.write(json.dumps(self.handle_request(line)).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    def handle_request(self, line: bytes) -> Dict[str, Any]:
+        self.requests += 1
+        try:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                raise ApiError("Invalid JSON")
+
+            if not isinstance(request, dict):
+                raise ApiError("Request must be an object")
+
+            op = request.get('op')
+            handler = self.ops.get(op) if isinstance(op, str) else None
+            if handler is None:
+                raise ApiError(f"Unknown op, expected one of: {', '.join(self.ops)}")
+
+            return {'ok': True, 'result': handler(request)}
+        except ApiError as e:
+            return {'ok': False, 'error': str(e)}
+
+    @staticmethod
+    def _param(request: Dict[str, Any], name: str) -> str:
+        value = request.get(name)
+        if not isinstance(value, str) or not value:
+            raise ApiError(f"Missing parameter '{name}'")
+
+        return value
+
+    def op_user(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        name = self._param(request, 'name')
+        if name not in self.conn.bnc_users:
+            raise ApiError("No such user")
+
+        return {'name': name, 'bindhost': self.conn.bnc_users[name]}
+
+    def op_host(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        host = self._param(request, 'host')
+        return {'host': host, 'users': list(self.conn.bnc_users.users_for_host(host))}
+
+    def op_queue(self, request: Dict[str, Any]) -> Dict[str, str]:
+        return dict(self.conn.bnc_queue)
+
+    def op_status(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        status = {
+            'connected': self.conn.connected,
+            'users': len(self.conn.bnc_users),
+            'queue': len(self.conn.bnc_queue),
+            'rtt_p50': self.conn.health.rtt.percentile(50),
+            'znc_saves': {
+                'requested': self.conn.znc_saves.requests,
+                'saved': self.conn.znc_saves.calls,
+                'avoided': self.conn.znc_saves.avoided,
+            },
+            'chan_log': {
+                'messages': self.conn.chan_log_writer.messages,
+                'lines': self.conn.chan_log_writer.lines,
+                'suppressed': self.conn.chan_log_writer.total_suppressed,
+            },
+        }
+        job = self.conn.scheduler.jobs.get('user_sync')
+        if job:
+            status['sync'] = {
+                'running': job.running,
+                'last_run': job.last_run,
+                'last_duration': job.last_duration,
+                'next_run': (
+                    None if job.next_run is None else time.time() + self.conn.scheduler.next_run_in(job)
+                ),
+                'runs': job.runs,
+                'failures': job.failures,
+            }
+
+        return status
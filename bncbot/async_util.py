@@ -3,34 +3,135 @@ Utility functions for working with asyncio
 """
 
 import asyncio
-from datetime import timedelta
+import importlib
 from functools import partial
+from typing import Callable, Dict, Hashable, Optional
+
+# Event loop implementations which can be selected with the "event_loop" config option
+LOOP_POLICIES = {
+    "asyncio": None,
+    "uvloop": "uvloop.EventLoopPolicy",
+}
 
 
 def is_coro(func) -> bool:
     return asyncio.iscoroutine(func) or asyncio.iscoroutinefunction(func)
 
 
+def set_loop_policy(name: Optional[str]) -> str:
+    """
+    Install the event loop policy for `name`, falling back to the default asyncio loop
+    if it isn't available. Must be called before the event loop is created.
+
+    :return: The name of the policy in use
+    """
+    path = LOOP_POLICIES.get(name or "asyncio")
+    if path is None:
+        return "asyncio"
+
+    module_name, _, attr = path.rpartition('.')
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError:
+        return "asyncio"
+
+    asyncio.set_event_loop_policy(getattr(module, attr)())
+    return name
+
+
 async def call_func(func, *args, **kwargs):
     part = partial(func, *args, **kwargs)
     if is_coro(func):
         return await part()
 
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
     return await loop.run_in_executor(None, part)
 
 
-async def timer(interval, func, *args, initial_interval=None):
-    if initial_interval is None:
-        initial_interval = interval
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key in to a single call whose result is shared by all callers
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, func, *args):
+        fut = self._calls.get(key)
+        if fut is None:
+            fut = self._calls[key] = asyncio.ensure_future(call_func(func, *args))
+            fut.add_done_callback(partial(self._done, key))
+
+        # Shield the shared call so one caller being cancelled doesn't cancel it for the others
+        return await asyncio.shield(fut)
+
+    def _done(self, key: Hashable, fut: asyncio.Future) -> None:
+        if self._calls.get(key) is fut:
+            del self._calls[key]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+class Debouncer:
+    """
+    Coalesces bursts of requests in to a single call of `func`, made once no request has been made for `delay`
+    seconds, or `max_delay` seconds after the first pending request, whichever is sooner
+    """
+
+    def __init__(self, func: Callable[[], None], delay: float, max_delay: float) -> None:
+        self.func = func
+        self.delay = delay
+        self.max_delay = max_delay
+        self.requests = 0
+        self.calls = 0
+        # Requests which were covered by another request's call
+        self.avoided = 0
+        self._pending = 0
+        self._first: Optional[float] = None
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._pending)
+
+    def request(self) -> None:
+        self.requests += 1
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+
+        now = loop.time()
+        if self._first is None:
+            self._first = now
+
+        if self._handle is not None:
+            self._handle.cancel()
+
+        self._handle = loop.call_at(min(now + self.delay, self._first + self.max_delay), self.flush)
+
+    def flush(self) -> None:
+        """Make the call now if any requests are pending"""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
 
-    if isinstance(interval, timedelta):
-        interval = interval.total_seconds()
+        if not self._pending:
+            return
 
-    if isinstance(initial_interval, timedelta):
-        initial_interval = initial_interval.total_seconds()
+        self.avoided += self._pending - 1
+        self._pending = 0
+        self._first = None
+        self.calls += 1
+        self.func()
 
-    await asyncio.sleep(initial_interval)
-    while True:
-        await call_func(func, *args)
-        await asyncio.sleep(interval)
+    def summary(self) -> str:
+        return "{} requested, {} made, {} avoided{}".format(
+            self.requests, self.calls, self.avoided, ", one pending" if self._pending else ""
+        )
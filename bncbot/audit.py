@@ -0,0 +1,169 @@
+# coding=utf-8
+"""
+Append-only audit log of BNC actions
+
+Records are stored as compact JSON lines in size-rotated segment files, and a
+dbm index maps each account name to the (time, segment, offset) of every record
+mentioning it, so the history for an account can be read without scanning the logs.
+The index also stores the end of the last record indexed, so records written but not
+indexed before a crash are indexed when the log is next opened.
+"""
+import bisect
+import dbm
+import json
+import os
+import struct
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+# (timestamp, segment number, byte offset) of a single record
+INDEX_ENTRY = struct.Struct('<dIQ')
+
+# (segment number, byte offset) of the end of the last indexed record, stored under POSITION_KEY
+POSITION = struct.Struct('<IQ')
+POSITION_KEY = b'\0position'
+
+
+class AuditLog:
+    def __init__(self, path: Path, max_bytes: int = 4 * 1024 * 1024) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        if not self.path.exists():
+            self.path.mkdir(parents=True)
+
+        self._index = dbm.open(str(self.path / "index"), 'c')
+        self.segment = max(self.segments(), default=0)
+        self._file = None
+        self._catch_up()
+
+    def segments(self) -> List[int]:
+        return sorted(int(p.stem.rpartition('.')[2]) for p in self.path.glob("audit.*.log"))
+
+    def _sync(self) -> None:
+        # Some dbm implementations (eg. dbm.dumb) only persist updated keys on sync or close
+        sync = getattr(self._index, 'sync', None)
+        if sync is not None:
+            sync()
+
+    def _add_entry(self, accounts: List[str], entry: bytes) -> None:
+        for key in {account.lower().encode() for account in accounts}:
+            self._index[key] = self._index.get(key, b'') + entry
+
+    def _catch_up(self) -> None:
+        """Index any records after the last indexed position"""
+        raw = self._index.get(POSITION_KEY)
+        last_segment, last_offset = POSITION.unpack(raw) if raw else (0, 0)
+        position = None
+        for segment in self.segments():
+            if segment < last_segment:
+                continue
+
+            with self.segment_file(segment).open('rb') as f:
+                offset = last_offset if segment == last_segment else 0
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # Partially written when the bot stopped, drop it so new records start on their own line
+                        f.close()
+                        os.truncate(str(self.segment_file(segment)), offset)
+                        break
+
+                    data = json.loads(line)
+                    indexed = {
+                        key: {(seg, off) for _, seg, off in INDEX_ENTRY.iter_unpack(self._index.get(key, b''))}
+                        for key in {account.lower().encode() for account in data['accounts']}
+                    }
+                    entry = INDEX_ENTRY.pack(data['time'], segment, offset)
+                    for key, locations in indexed.items():
+                        if (segment, offset) not in locations:
+                            self._index[key] = self._index.get(key, b'') + entry
+
+                    offset += len(line)
+                    position = (segment, offset)
+
+        if position is not None:
+            self._index[POSITION_KEY] = POSITION.pack(*position)
+            self._sync()
+
+    def segment_file(self, segment: int) -> Path:
+        return self.path / f"audit.{segment:06d}.log"
+
+    def _open_segment(self):
+        if self._file is None:
+            self._file = self.segment_file(self.segment).open('ab')
+
+        if self._file.tell() >= self.max_bytes:
+            self._file.close()
+            self.segment += 1
+            self._file = self.segment_file(self.segment).open('ab')
+
+        return self._file
+
+    def record(self, action: str, *accounts: str, actor: str = None, **details: Any) -> None:
+        """Append a record of `action` and index it under each of `accounts`"""
+        now = time.time()
+        data = {'time': round(now, 3), 'action': action, 'accounts': list(accounts)}
+        if actor:
+            data['actor'] = actor
+
+        data.update(details)
+        f = self._open_segment()
+        offset = f.tell()
+        line = json.dumps(data, separators=(',', ':')).encode() + b'\n'
+        f.write(line)
+        f.flush()
+
+        self._add_entry(list(accounts), INDEX_ENTRY.pack(now, self.segment, offset))
+        self._index[POSITION_KEY] = POSITION.pack(self.segment, offset + len(line))
+        self._sync()
+
+    def history(self, account: str, limit: int = 10, since: float = None) -> List[Dict[str, Any]]:
+        """Get the newest `limit` records for `account`, optionally only those after `since`, oldest first"""
+        raw = self._index.get(account.lower().encode(), b'')
+        entries = list(INDEX_ENTRY.iter_unpack(raw))
+        if since is not None:
+            entries = entries[bisect.bisect_left([entry[0] for entry in entries], since):]
+
+        if limit:
+            entries = entries[-limit:]
+
+        if self._file is not None:
+            self._file.flush()
+
+        out = []
+        files = {}
+        try:
+            for _, segment, offset in entries:
+                f = files.get(segment)
+                if f is None:
+                    f = files[segment] = self.segment_file(segment).open('rb')
+
+                f.seek(offset)
+                out.append(json.loads(f.readline()))
+        finally:
+            for f in files.values():
+                f.close()
+
+        return out
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        self._index.close()
+
+
+def format_record(data: Dict[str, Any]) -> str:
+    """Render a history record as a single line for IRC"""
+    when = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(data['time']))
+    out = f"[{when} UTC] {data['action']} {', '.join(data['accounts'])}"
+    if data.get('actor'):
+        out += f" by {data['actor']}"
+
+    extra = {k: v for k, v in data.items() if k not in ('time', 'action', 'accounts', 'actor')}
+    if extra:
+        out += " (" + ", ".join(f"{k}: {v}" for k, v in extra.items()) + ")"
+
+    return out
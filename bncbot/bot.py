@@ -1,10 +1,12 @@
 # coding=utf-8
 import asyncio
-import re
+import time
+from datetime import timedelta
 from itertools import chain
 from typing import NamedTuple, Callable, TYPE_CHECKING, List
 
 from bncbot import util
+from bncbot.audit import format_record
 from bncbot.event import CommandEvent, RawEvent
 from bncbot.util import chunk_str, sanitize_username
 
@@ -25,6 +27,16 @@ class Command(NamedTuple):
 
 HANDLERS = {}
 
+# Maximum number of results returned by bncfind
+FIND_LIMIT = 20
+
+# Reply to requestbnc when a services lookup times out or the connection drops
+LOOKUP_FAILED = "Unable to look up your account with services right now, please try again in a few minutes"
+
+# Default and maximum length of a bncprofile session, in seconds
+PROFILE_DEFAULT = 60
+PROFILE_MAX = 600
+
 
 def raw(*cmds):
     """Register a function as a handler for all raw commands in [cmds]"""
@@ -55,6 +67,12 @@ def command(name, *aliases, admin=False, require_param=True):
     return _decorate
 
 
+def account_names(nick: str) -> List[str]:
+    """The names an account for `nick` is known by, its nick and its sanitized username if that differs"""
+    username = sanitize_username(nick)
+    return [nick] if username == nick else [nick, username]
+
+
 @raw
 async def on_raw(conn: 'Conn', event: 'RawEvent', irc_command: str):
     conn.logger.info('[incoming] %s', event.irc_rawline)
@@ -63,9 +81,33 @@ async def on_raw(conn: 'Conn', event: 'RawEvent', irc_command: str):
 
 
 @raw('JOIN')
-def on_join(conn, chan, nick):
-    if chan == conn.log_chan and nick.lower() == conn.nick.lower():
-        conn.chan_log("Bot online.")
+async def on_join(conn, chan, nick):
+    if nick.lower() == conn.nick.lower():
+        conn.channels[chan.lower()] = chan
+        if chan == conn.log_chan:
+            conn.chan_log("Bot online.")
+
+
+@raw('PART')
+async def on_part(conn: 'Conn', irc_paramlist: List[str], nick: str):
+    if nick.lower() == conn.nick.lower():
+        conn.channels.pop(irc_paramlist[0].lower(), None)
+
+
+@raw('KICK')
+async def on_kick(conn: 'Conn', irc_paramlist: List[str]):
+    if irc_paramlist[1].lower() == conn.nick.lower():
+        conn.channels.pop(irc_paramlist[0].lower(), None)
+
+
+@raw('001')
+async def on_welcome(conn: 'Conn'):
+    conn.restore_session()
+
+
+@raw('PONG')
+async def on_pong(conn: 'Conn', irc_paramlist: List[str]):
+    conn.health.on_pong(irc_paramlist[-1])
 
 
 @raw('318')
@@ -73,7 +115,8 @@ async def on_whois_end(conn: 'Conn', irc_paramlist: List[str]):
     to_remove = []
     for name, fut in conn.futures.items():
         if name.startswith('whois') and name.endswith(irc_paramlist[1]):
-            fut.set_result('')
+            if not fut.done():
+                fut.set_result('')
             to_remove.append(name)
     for name in to_remove:
         del conn.futures[name]
@@ -83,7 +126,7 @@ async def on_whois_end(conn: 'Conn', irc_paramlist: List[str]):
 async def on_whois_acct(conn: 'Conn', irc_paramlist: List[str]):
     if irc_paramlist[-1] == "is logged in as":
         fut = conn.futures.get("whois_acct_" + irc_paramlist[1])
-        if fut:
+        if fut and not fut.done():
             fut.set_result(irc_paramlist[2])
             del conn.futures['whois_acct_' + irc_paramlist[1]]
 
@@ -97,33 +140,23 @@ async def on_notice(irc_paramlist: List[str], conn: 'Conn', nick: str):
         message = message.strip()
         part, content = message.split(':', 1)
         content = content.strip()
-        if part == "Registered" and 'ns_info' in conn.futures:
-            conn.futures['ns_info'].set_result(content)
+        fut = conn.futures.get('ns_info')
+        if part == "Registered" and fut and not fut.done():
+            fut.set_result(content)
 
 
 @raw('PRIVMSG')
 async def on_privmsg(event: 'RawEvent', irc_paramlist: List[str], conn: 'Conn',
-                     nick: str, host: str, bnc_users, is_admin: bool) -> None:
+                     nick: str, host: str, is_admin: bool) -> None:
     message = irc_paramlist[-1]
     if nick.startswith(conn.prefix) and host == "znc.in":
         znc_module = nick[len(conn.prefix):]
-        if znc_module == "status" and conn.futures.get('user_list'):
-            match = re.match(
-                r'^\|\s*(.+?)\s*\|\s*\d+\s*\|\s*\d+\s*\|$', message
-            )
-            if match:
-                user = match.group(1)
-                bnc_users[user] = None
-            elif re.match(r'^([=+]+|[-+]+)$', message):
-                conn.get_users_state += 1
-                if conn.get_users_state == 3:
-                    conn.futures['user_list'].set_result(None)
-        elif znc_module == "controlpanel" and conn.futures.get('bindhost') and message.startswith("BindHost = "):
-            _, _, host = message.partition('=')
-            conn.futures['bindhost'].set_result(host.strip())
-        elif znc_module == "controlpanel" and conn.futures.get("bncadmin") and message.startswith("Admin = "):
-            _, _, is_admin = message.partition('=')
-            conn.futures["bncadmin"].set_result(is_admin.strip() == "true")
+        var, sep, value = message.partition(' = ')
+        fut = conn.futures.get('cp_get_' + var.lower()) if znc_module == "controlpanel" and sep else None
+        if fut and not fut.done():
+            fut.set_result(value.strip())
+        else:
+            conn.table_line(znc_module, message)
     elif message[0] in conn.cmd_prefix:
         cmd, _, text = message[1:].partition(' ')
         text = text.strip()
@@ -146,47 +179,82 @@ async def on_nick(conn: 'Conn', irc_paramlist: List[str], nick: str):
 
 
 @command("acceptbnc", admin=True)
-async def cmd_acceptbnc(text: str, conn: 'Conn', bnc_queue, message):
+async def cmd_acceptbnc(text: str, conn: 'Conn', bnc_queue, message, event):
     """<user> - Accepts [user]'s BNC request and sends their login info via a MemoServ memo"""
     nick = text.split(None, 1)[0]
-    if nick not in bnc_queue:
-        message(f"{nick} is not in the BNC queue.")
-        return
-    conn.rem_queue(nick)
-    if conn.add_user(nick):
-        conn.chan_log(
-            f"{nick} has been set with BNC access and memoserved credentials."
-        )
-    else:
-        conn.chan_log(
-            f"Error occurred when attempting to add {nick} to the BNC"
-        )
+    async with conn.account_lock(nick, sanitize_username(nick)):
+        if nick not in bnc_queue:
+            message(f"{nick} is not in the BNC queue.")
+            return
+        conn.rem_queue(nick)
+        if conn.add_user(nick):
+            conn.audit.record("accept", *account_names(nick), actor=event.nick)
+            conn.chan_log(
+                f"{nick} has been set with BNC access and memoserved credentials."
+            )
+        else:
+            conn.chan_log(
+                f"Error occurred when attempting to add {nick} to the BNC"
+            )
 
 
 @command("denybnc", admin=True)
-async def cmd_denybnc(text: str, message, bnc_queue, conn: 'Conn'):
+async def cmd_denybnc(text: str, message, bnc_queue, conn: 'Conn', event):
     """<user> - Deny [user]'s BNC request"""
     nick = text.split()[0]
-    if nick not in bnc_queue:
-        message(f"{nick} is not in the BNC queue.")
-        return
-    conn.rem_queue(nick)
-    message(
-        f"SEND {nick} Your BNC auth could not be added at this time",
-        "MemoServ"
-    )
+    async with conn.account_lock(nick):
+        if nick not in bnc_queue:
+            message(f"{nick} is not in the BNC queue.")
+            return
+        conn.rem_queue(nick)
+        message(
+            f"SEND {nick} Your BNC auth could not be added at this time",
+            "MemoServ"
+        )
+        conn.audit.record("deny", nick, actor=event.nick)
     conn.chan_log(f"{nick} has been denied. Memoserv sent.")
 
 
 @command("bncrefresh", admin=True, require_param=False)
 async def cmd_bncrefresh(conn: 'Conn', message, nick: str):
     """- Refresh BNC account data (Warning: operation is slow)"""
+    if conn.scheduler.is_running("user_sync"):
+        message("A BNC user list update is already in progress")
+        return
+
     message("Updating user list")
     conn.chan_log(f"{nick} is updating the BNC user list...")
-    await conn.get_user_hosts()
+    await conn.scheduler.run_job("user_sync")
     conn.chan_log("BNC user list updated.")
 
 
+@command("bnctimers", admin=True, require_param=False)
+async def cmd_bnctimers(conn: 'Conn', message):
+    """- View the status of the bot's scheduled jobs and deferred ZNC config saves"""
+    message(f"znc saveconfig: {conn.znc_saves.summary()}")
+    if not conn.scheduler.jobs:
+        message("No jobs are scheduled")
+        return
+
+    for job in conn.scheduler.jobs.values():
+        out = f"{job.name}: every {timedelta(seconds=int(job.interval))}"
+        if job.running:
+            out += ", running now"
+        else:
+            next_run = conn.scheduler.next_run_in(job)
+            if next_run is not None:
+                out += f", next run in {timedelta(seconds=int(next_run))}"
+
+        if job.last_run is not None:
+            ago = timedelta(seconds=int(time.time() - job.last_run))
+            out += f", last run {ago} ago"
+            if job.last_duration is not None and not job.running:
+                out += f" taking {job.last_duration:.2f}s"
+
+        out += f" ({job.runs} runs, {job.skipped} skipped, {job.failures} failed)"
+        message(out)
+
+
 @command("bncqueue", "bncq", admin=True, require_param=False)
 async def cmd_bncqueue(bnc_queue, message):
     """- View the current BNC queue"""
@@ -198,32 +266,32 @@ async def cmd_bncqueue(bnc_queue, message):
 
 
 @command("delbnc", admin=True)
-async def cmd_delbnc(text: str, conn: 'Conn', bnc_users, chan: str, message,
-                     nick: str):
+async def cmd_delbnc(text: str, conn: 'Conn', chan: str, message, nick: str):
     """<user> - Delete [user]'s BNC account"""
     acct = text.split()[0]
-    if acct not in bnc_users:
-        message(f"{acct} is not a current BNC user")
-        return
-    conn.module_msg('controlpanel', f"deluser {acct}")
-    conn.send("znc saveconfig")
-    del bnc_users[acct]
+    async with conn.account_lock(acct):
+        if acct not in conn.bnc_users:
+            message(f"{acct} is not a current BNC user")
+            return
+        conn.del_user(acct)
+        conn.audit.record("delete", acct, actor=nick)
     conn.chan_log(f"{nick} removed BNC: {acct}")
     if chan != conn.log_chan:
         message(f"BNC removed")
-    conn.save_data()
 
 
 @command("bncresetpass", admin=True)
-async def cmd_resetpass(conn: 'Conn', text: str, bnc_users, message):
+async def cmd_resetpass(conn: 'Conn', text: str, message, event):
     """<user> - Resets [user]'s BNC account password and sends them the new info in a MemoServ memo"""
     nick = text.split()[0]
-    if nick not in bnc_users:
-        message(f"{nick} is not a BNC user.")
-        return
-    passwd = util.gen_pass()
-    conn.module_msg('controlpanel', f"Set Password {nick} {passwd}")
-    conn.send("znc saveconfig")
+    async with conn.account_lock(nick):
+        if nick not in conn.bnc_users:
+            message(f"{nick} is not a BNC user.")
+            return
+        passwd = util.gen_pass()
+        conn.module_msg('controlpanel', f"Set Password {nick} {passwd}")
+        conn.save_znc_config()
+        conn.audit.record("resetpass", nick, actor=event.nick)
     message(f"BNC password reset for {nick}")
     message(
         f"SEND {nick} [New Password!] Your BNC auth is Username: {nick} "
@@ -234,40 +302,51 @@ async def cmd_resetpass(conn: 'Conn', text: str, bnc_users, message):
 
 
 @command("addbnc", "bncadd", admin=True)
-async def cmd_addbnc(text: str, conn: 'Conn', bnc_users, message):
+async def cmd_addbnc(text: str, conn: 'Conn', message, nick: str):
     """<user> - Add a BNC account for [user] and MemoServ [user] the login credentials"""
     acct = text.split()[0]
-    if acct in bnc_users:
-        message("A BNC account with that name already exists")
-    else:
-        if conn.add_user(acct):
-            conn.chan_log(
-                f"{acct} has been set with BNC access and memoserved credentials."
-            )
+    async with conn.account_lock(acct, sanitize_username(acct)):
+        if acct in conn.bnc_users:
+            message("A BNC account with that name already exists")
         else:
-            conn.chan_log(
-                f"Error occurred when attempting to add {acct} to the BNC"
-            )
+            if conn.add_user(acct):
+                conn.audit.record("add", *account_names(acct), actor=nick)
+                conn.chan_log(
+                    f"{acct} has been set with BNC access and memoserved credentials."
+                )
+            else:
+                conn.chan_log(
+                    f"Error occurred when attempting to add {acct} to the BNC"
+                )
 
 
 @command("bncsetadmin", admin=True)
-async def cmd_setadmin(text: str, bnc_users, message, conn: 'Conn'):
+async def cmd_setadmin(text: str, message, conn: 'Conn', nick: str):
     """<user> - Makes [user] a BNC admin"""
     acct = text.split()[0]
-    if acct in bnc_users:
-        conn.module_msg('controlpanel', f"Set Admin {acct} true")
-        conn.send("znc saveconfig")
-        message(f"{acct} has been set as a BNC admin")
-    else:
-        message(f"{acct} does not exist as a BNC account")
+    async with conn.account_lock(acct):
+        if acct in conn.bnc_users:
+            conn.module_msg('controlpanel', f"Set Admin {acct} true")
+            conn.save_znc_config()
+            conn.audit.record("setadmin", acct, actor=nick)
+            message(f"{acct} has been set as a BNC admin")
+        else:
+            message(f"{acct} does not exist as a BNC account")
 
 
 @command("requestbnc", "bncrequest", require_param=False)
-async def cmd_requestbnc(nick: str, conn: 'Conn', message, bnc_users, loop, bnc_queue):
+async def cmd_requestbnc(nick: str, conn: 'Conn', message, bnc_queue):
     """- Submits a request for a BNC account"""
-    conn.futures['whois_acct_' + nick] = loop.create_future()
-    conn.send("WHOIS", nick)
-    acct = await conn.futures['whois_acct_' + nick]
+    if not conn.lookup_limiter.allow(nick.lower()):
+        message("You are sending requests too quickly, please try again later", nick)
+        return
+
+    try:
+        acct = await conn.whois_account(nick)
+    except (asyncio.TimeoutError, ConnectionError):
+        message(LOOKUP_FAILED, nick)
+        return
+
     if not acct:
         message(
             "You must be identified with services to request a BNC account",
@@ -277,32 +356,123 @@ async def cmd_requestbnc(nick: str, conn: 'Conn', message, bnc_users, loop, bnc_
     username = acct
     username = sanitize_username(username)
 
-    if username in bnc_users:
-        message(
-            "It appears you already have a BNC account. If this is in error, please contact staff in #help",
-            nick
-        )
-        return
-    if acct in bnc_queue:
-        message(
-            "It appears you have already submitted a BNC request. If this is in error, please contact staff in #help",
-            nick
-        )
-        return
-    if 'ns_info' not in conn.locks:
-        conn.locks['ns_info'] = asyncio.Lock(loop=loop)
-    async with conn.locks['ns_info']:
-        conn.futures['ns_info'] = loop.create_future()
-        message(f"INFO {acct}", "NickServ")
-        registered_time = await conn.futures['ns_info']
-        del conn.futures['ns_info']
-    conn.add_queue(acct, registered_time)
+    async with conn.account_lock(acct, username):
+        if username in conn.bnc_users:
+            message(
+                "It appears you already have a BNC account. If this is in error, please contact staff in #help",
+                nick
+            )
+            return
+        if acct in bnc_queue:
+            message(
+                "It appears you have already submitted a BNC request. If this is in error, please contact staff in #help",
+                nick
+            )
+            return
+        try:
+            registered_time = await conn.ns_registered_time(acct)
+        except (asyncio.TimeoutError, ConnectionError):
+            message(LOOKUP_FAILED, nick)
+            return
+
+        conn.add_queue(acct, registered_time)
     message("BNC request submitted.", nick)
     conn.chan_log(
         f"{acct} added to bnc queue. Registered {registered_time}"
     )
 
 
+@command("bncfind", admin=True)
+async def cmd_bncfind(text: str, bnc_users, message):
+    """<pattern> - Find BNC accounts by name prefix or glob, or by bindhost if [pattern] starts with a digit"""
+    pattern = text.split()[0]
+    if pattern[0].isdigit() or ':' in pattern:
+        results = [f"{name} ({host})" for host, name in bnc_users.find_hosts(pattern, FIND_LIMIT + 1)]
+    else:
+        results = [f"{name} ({bnc_users[name]})" for name in bnc_users.find_users(pattern, FIND_LIMIT + 1)]
+
+    if not results:
+        message(f"No BNC accounts match '{pattern}'")
+        return
+
+    msg = f"Matches for '{pattern}': {', '.join(results[:FIND_LIMIT])}"
+    if len(results) > FIND_LIMIT:
+        msg += f" (showing first {FIND_LIMIT})"
+
+    for chunk in chunk_str(msg):
+        message(chunk)
+
+
+@command("bnclocks", admin=True, require_param=False)
+async def cmd_bnclocks(conn: 'Conn', message):
+    """- View lock contention statistics and any operations waiting on a lock"""
+    message(conn.locks.summary())
+    waiting = sorted(conn.locks.waiting().items(), key=lambda item: item[1], reverse=True)
+    if waiting:
+        message("Waiting: " + ", ".join(f"{key} ({count})" for key, count in waiting[:10]))
+
+
+@command("bncprofile", admin=True, require_param=False)
+async def cmd_bncprofile(text: str, conn: 'Conn', chan: str, message, nick: str):
+    """[start [seconds]|stop] - Profile the bot's CPU and memory use for up to [seconds], or view the current session"""
+    action, _, arg = text.partition(' ')
+    action = action.lower()
+    if action == "start":
+        try:
+            duration = min(int(arg or PROFILE_DEFAULT), PROFILE_MAX)
+        except ValueError:
+            message(f"Invalid duration '{arg}'")
+            return
+
+        if duration < 1:
+            message("The duration must be at least 1 second")
+            return
+
+        try:
+            conn.profiling.start(duration)
+        except ValueError as e:
+            message(str(e))
+            return
+
+        conn.chan_log(f"{nick} started a {duration}s profiling session")
+    elif action == "stop":
+        try:
+            summary = conn.profiling.stop()
+        except ValueError as e:
+            message(str(e))
+            return
+
+        if chan != conn.log_chan:
+            for line in summary:
+                message(line)
+    elif conn.profiling.running:
+        elapsed = time.time() - conn.profiling.started
+        message(f"Profiling for {elapsed:.0f}s of {conn.profiling.duration:.0f}s")
+    else:
+        message("No profiling session is running")
+
+
+@command("bncping", admin=True, require_param=False)
+async def cmd_bncping(conn: 'Conn', message):
+    """- View the round-trip latency to ZNC"""
+    message(conn.health.summary())
+
+
+@command("bnchistory", admin=True)
+async def cmd_bnchistory(text: str, conn: 'Conn', message):
+    """<user> [count] - View the most recent recorded BNC actions for [user]"""
+    acct, _, count = text.partition(' ')
+    count = count.strip()
+    limit = max(1, min(int(count), 25)) if count.isdigit() else 10
+    records = conn.audit.history(acct, limit)
+    if not records:
+        message(f"No BNC history found for {acct}")
+        return
+
+    for record in records:
+        message(format_record(record))
+
+
 @command("genbindhost", require_param=False, admin=True)
 async def cmd_genbindhost(conn: 'Conn', message):
     """- Generate a unique bind host and return it"""
@@ -0,0 +1,74 @@
+# coding=utf-8
+"""
+Raw IRC traffic capture, for replaying real traffic offline with `python -m bncbot.replay`
+
+Each line is stored as "<unix time> <direction> <raw line>", direction being '<' for received lines and '>' for sent ones.
+Passwords are redacted before lines are written, but captures still contain private traffic so are only readable by
+the bot's user.
+"""
+import logging
+import os
+import re
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple
+
+RECEIVED = '<'
+SENT = '>'
+
+REDACTED = "<redacted>"
+
+# Password arguments in controlpanel commands, credential memos and registration
+PASSWORD_PATTERNS = (
+    re.compile(r'(\bSet Password \S+ )\S+', re.IGNORECASE),
+    re.compile(r'(\bPassword: )\S+', re.IGNORECASE),
+    re.compile(r'(/PASS \S+?:)\S+', re.IGNORECASE),
+    re.compile(r'^(PASS :?)\S+', re.IGNORECASE),
+)
+
+
+def redact(line: str) -> str:
+    for pattern in PASSWORD_PATTERNS:
+        line = pattern.sub(r'\g<1>' + REDACTED, line)
+
+    return line
+
+
+class CapturedLine(NamedTuple):
+    time: float
+    direction: str
+    line: str
+
+
+class _PrivateRotatingFileHandler(RotatingFileHandler):
+    def _open(self):
+        fd = os.open(self.baseFilename, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        # The file may have been created before captures were private
+        os.fchmod(fd, 0o600)
+        return open(fd, self.mode, encoding=self.encoding)
+
+
+class TrafficCapture:
+    def __init__(self, path: Path, max_bytes: int = 10000000, backup_count: int = 5) -> None:
+        self.path = path
+        self.lines = 0
+        self._handler = _PrivateRotatingFileHandler(
+            str(path), maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True
+        )
+        self._handler.setFormatter(logging.Formatter("%(created).6f %(message)s"))
+
+    def record(self, direction: str, line: str) -> None:
+        self.lines += 1
+        self._handler.handle(logging.makeLogRecord({'msg': f"{direction} {redact(line)}"}))
+
+    def close(self) -> None:
+        self._handler.close()
+
+
+def read_capture(paths: Iterable[Path]) -> Iterator[CapturedLine]:
+    """Read captured lines from `paths`, which should be given oldest first"""
+    for path in paths:
+        with path.open(encoding='utf-8') as f:
+            for line in f:
+                timestamp, direction, raw_line = line.rstrip('\r\n').split(' ', 2)
+                yield CapturedLine(float(timestamp), direction, raw_line)
@@ -0,0 +1,145 @@
+# coding=utf-8
+"""
+Buffered, rate limited output to the log channel
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from bncbot.conn import Conn
+
+SEPARATOR = " | "
+
+# Longest line the writer will build from merged messages, leaving room for the PRIVMSG prefix
+MAX_LENGTH = 400
+
+
+class ChanLogWriter:
+    """
+    Merges messages logged within `window` seconds in to as few lines as possible,
+    collapsing repeats of the same message in to a count, and sends at most `lines_per_minute` lines a minute.
+    Messages over the limit are dropped and summarized once the limit allows.
+    """
+
+    def __init__(self, conn: 'Conn', window: float = 1.0, lines_per_minute: int = 20) -> None:
+        self.conn = conn
+        self.window = window
+        self.lines_per_minute = lines_per_minute
+        self.messages = 0
+        self.lines = 0
+        self.total_suppressed = 0
+        # Messages dropped since the last summary was sent
+        self.suppressed = 0
+        self._pending: Dict[str, int] = {}
+        self._sent: Deque[float] = deque()
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+    def _on_loop_thread(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.conn.loop
+        except RuntimeError:
+            return False
+
+    def write(self, msg: str) -> None:
+        if self.conn.loop is not None and not self._on_loop_thread():
+            # Called from a synchronous handler in an executor thread
+            self.conn.loop.call_soon_threadsafe(self.write, msg)
+            return
+
+        self.messages += 1
+        if self._budget(time.monotonic()) <= 0:
+            # Over the limit until the oldest line leaves the window, which is when the summary is sent
+            self.suppressed += 1
+            self.total_suppressed += 1
+            return
+
+        self._pending[msg] = self._pending.get(msg, 0) + 1
+        if self.conn.loop is None:
+            # Nothing to schedule the flush on yet
+            self.flush()
+        else:
+            self._schedule(self.window)
+
+    def _schedule(self, delay: float) -> None:
+        when = self.conn.loop.time() + delay
+        if self._handle is not None:
+            if self._handle.when() <= when:
+                return
+
+            self._handle.cancel()
+
+        self._handle = self.conn.loop.call_at(when, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._handle = None
+        self.flush()
+
+    def _pack(self) -> List[Tuple[str, int]]:
+        """Merge the pending messages in to lines, returns (line, message count) pairs"""
+        lines = []
+        current, count = "", 0
+        for msg, repeats in self._pending.items():
+            if repeats > 1:
+                msg = f"{msg} (x{repeats})"
+
+            if current and len(current) + len(SEPARATOR) + len(msg) <= MAX_LENGTH:
+                current += SEPARATOR + msg
+                count += repeats
+            else:
+                if current:
+                    lines.append((current, count))
+
+                current, count = msg, repeats
+
+        if current:
+            lines.append((current, count))
+
+        self._pending.clear()
+        return lines
+
+    def _budget(self, now: float) -> int:
+        while self._sent and now - self._sent[0] >= 60:
+            self._sent.popleft()
+
+        return self.lines_per_minute - len(self._sent)
+
+    def _send(self, line: str, now: float) -> None:
+        self._sent.append(now)
+        self.lines += 1
+        self.conn.msg(self.conn.log_chan, line)
+
+    def flush(self, force: bool = False) -> None:
+        """Send the pending messages now, `force` ignores the rate limit"""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        if not self.conn.log_chan:
+            self._pending.clear()
+            return
+
+        now = time.monotonic()
+        budget = self._budget(now)
+        if self.suppressed and (budget > 0 or force):
+            self._send(f"Log output rate limited, {self.suppressed} messages suppressed", now)
+            self.suppressed = 0
+            budget -= 1
+
+        for line, count in self._pack():
+            if budget > 0 or force:
+                self._send(line, now)
+                budget -= 1
+            else:
+                self.suppressed += count
+                self.total_suppressed += count
+
+        if self.suppressed and self.conn.loop is not None:
+            # Send the summary as soon as the oldest line leaves the window
+            self._schedule(60 - (now - self._sent[0]))
+
+    def summary(self) -> str:
+        return "{} messages logged in {} lines, {} suppressed".format(
+            self.messages, self.lines, self.total_suppressed
+        )
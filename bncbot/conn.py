@@ -5,21 +5,46 @@ import ipaddress
 import json
 import logging
 import logging.config
-from collections import defaultdict
+import os
+import random
 from datetime import timedelta
 from fnmatch import fnmatch
+from functools import partial
 from pathlib import Path
-from typing import List, Optional, Dict, TYPE_CHECKING
+from typing import Callable, List, Optional, Dict, Set, TYPE_CHECKING
 
 from asyncirc.protocol import IrcProtocol
 from asyncirc.server import Server
 
 from bncbot import irc, util
-from bncbot.async_util import call_func, timer
+from bncbot.api import QueryServer
+from bncbot.async_util import call_func, Debouncer, SingleFlight
+from bncbot.audit import AuditLog
+from bncbot.capture import RECEIVED, SENT, TrafficCapture
+from bncbot.chanlog import ChanLogWriter
+from bncbot.health import HealthMonitor
+from bncbot.locks import KeyedLock
+from bncbot.profiling import ProfileSession
+from bncbot.scheduler import Scheduler
+from bncbot.table import TableParser
+from bncbot.usertable import UserTable
 
 if TYPE_CHECKING:
     from asyncirc.irc import Message
 
+# How long to wait for a reply from services or ZNC before giving up on a lookup
+LOOKUP_TIMEOUT = 30
+
+# Bounds for the delay between reconnect attempts, which doubles after each failure
+RECONNECT_DELAY = 5
+MAX_RECONNECT_DELAY = 300
+CONNECT_TIMEOUT = 60
+
+# ZNC rewrites its whole config file on each saveconfig, so saves are held until changes stop for
+# SAVECONFIG_DELAY seconds, but no longer than SAVECONFIG_MAX_DELAY after the first change
+SAVECONFIG_DELAY = 5
+SAVECONFIG_MAX_DELAY = 30
+
 
 class Conn:
     def __init__(self, handlers) -> None:
@@ -27,17 +52,31 @@ class Conn:
         self._protocol = None
         self.handlers = handlers
         self.futures = {}
-        self.locks = defaultdict(asyncio.Lock)
-        self.loop = asyncio.get_event_loop()
+        self.locks = KeyedLock()
+        self.lookups = SingleFlight()
+        self.znc_saves = Debouncer(partial(self.send, "znc saveconfig"), SAVECONFIG_DELAY, SAVECONFIG_MAX_DELAY)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
         self.bnc_data = {}
-        self.stopped_future = self.loop.create_future()
-        self.get_users_state = 0
+        self.stopped_future: Optional[asyncio.Future] = None
+        self.table_parsers: Dict[str, TableParser] = {}
+        self.channels: Dict[str, str] = {}
+        self.reconnecting = False
+        # Accounts changed while a user sync is in progress
+        self._sync_touched: Optional[Set[str]] = None
         self.config = {}
         if not self.log_dir.exists():
             self.log_dir.mkdir()
 
+        self.audit = AuditLog(self.log_dir / "audit")
         self.setup_logger()
         self.logger = logging.getLogger("bncbot")
+        self.scheduler = Scheduler(self.logger)
+        self.health = HealthMonitor(self)
+        self.api: Optional[QueryServer] = None
+        self.capture: Optional[TrafficCapture] = None
+        self.chan_log_writer = ChanLogWriter(self)
+        self.profiling = ProfileSession(self)
+        self.lookup_limiter = util.RateLimiter(3, 60)
 
     def setup_logger(self):
         do_debug = self.config.get("debug", False)
@@ -112,64 +151,159 @@ class Conn:
                 self.bnc_data = json.load(f)
 
         self.bnc_data.setdefault('queue', {})
-        self.bnc_data.setdefault('users', {})
+        self.bnc_data['users'] = UserTable(self.bnc_data.get('users'))
         self.save_data()
         if update and not self.bnc_users:
-            asyncio.ensure_future(self.get_user_hosts(), loop=self.loop)
+            self.scheduler.trigger("user_sync")
 
     def save_data(self) -> None:
-        with self.data_file.open('w', encoding='utf8') as f:
-            json.dump(self.bnc_data, f, indent=2, sort_keys=True)
+        # Write to a temporary file and swap it in, so readers never see a partially written file
+        tmp_file = self.data_file.with_name(self.data_file.name + ".tmp")
+        with tmp_file.open('w', encoding='utf8') as f:
+            json.dump(dict(self.bnc_data, users=dict(self.bnc_users.items())), f, indent=2, sort_keys=True)
+
+        os.replace(str(tmp_file), str(self.data_file))
+
+    async def run(self) -> bool:
+        """Run the bot until it is shut down, returns whether it should be restarted"""
+        self.loop = asyncio.get_running_loop()
+        self.stopped_future = self.loop.create_future()
+        if self.config.get('capture_traffic'):
+            self.capture = TrafficCapture(self.log_dir / "traffic.log")
 
-    def run(self) -> bool:
-        self.load_config()
-        self.loop.run_until_complete(self.connect())
-        self.load_data(True)
-        self.start_timers()
-        restart = self.loop.run_until_complete(self.stopped_future)
-        self.loop.stop()
-        return restart
+        await self.connect()
+        if not self.stopped_future.done():
+            self.start_timers()
+            self.load_data(True)
+            if self.api_socket:
+                self.api = QueryServer(self, self.api_socket)
+                await self.api.start()
 
-    def create_timer(self, interval, func, *args, initial_interval=None):
-        asyncio.ensure_future(timer(interval, func, *args, initial_interval=initial_interval), loop=self.loop)
+        return await self.stopped_future
+
+    def create_timer(self, name, interval, func, *args, initial_interval=None, jitter=0):
+        return self.scheduler.add(name, interval, func, *args, initial_interval=initial_interval, jitter=jitter)
 
     def start_timers(self) -> None:
-        self.create_timer(timedelta(hours=8), self.get_user_hosts)
+        self.create_timer("user_sync", timedelta(hours=8), self.get_user_hosts, jitter=timedelta(minutes=5))
+        self.create_timer("health", 30, self.health.check)
 
     def send(self, *parts) -> None:
-        self._protocol.send(' '.join(parts))
+        line = ' '.join(parts)
+        if self.capture:
+            self.capture.record(SENT, line)
+
+        self._protocol.send(line)
 
     def module_msg(self, name: str, cmd: str) -> None:
         self.msg(self.prefix + name, cmd)
 
+    async def query_table(self, module: str, cmd: str) -> List[tuple]:
+        """Send `cmd` to a ZNC module and collect the rows of the table it replies with"""
+        async with self.locks["table_" + module]:
+            parser = TableParser()
+            fut = self.loop.create_future()
+            self.table_parsers[module] = parser
+            self.futures["table_" + module] = fut
+            self.module_msg(module, cmd)
+            try:
+                # Large tables can take a long time to arrive, so only give up once ZNC stops sending lines
+                lines = -1
+                while not fut.done():
+                    if parser.lines == lines:
+                        raise asyncio.TimeoutError(f"No reply from {self.prefix}{module} to '{cmd}'")
+
+                    lines = parser.lines
+                    await asyncio.wait([fut], timeout=LOOKUP_TIMEOUT)
+
+                fut.result()
+            finally:
+                self.table_parsers.pop(module, None)
+                self.futures.pop("table_" + module, None)
+
+        if parser.message:
+            self.logger.debug("%s%s replied to '%s' with: %s", self.prefix, module, cmd, parser.message)
+
+        return parser.rows
+
+    def table_line(self, module: str, line: str) -> bool:
+        """Pass a line from a ZNC module to its pending table query, returns False if there is none"""
+        parser = self.table_parsers.get(module)
+        if not parser:
+            return False
+
+        if parser.feed(line):
+            fut = self.futures.get("table_" + module)
+            if fut and not fut.done():
+                fut.set_result(None)
+
+        return True
+
+    async def list_users(self) -> List[tuple]:
+        """Rows of (username, networks, clients) for every ZNC user"""
+        return await self.query_table("status", "ListUsers")
+
+    async def list_networks(self, user: str = None) -> List[tuple]:
+        """Rows of (network, on_irc, irc_server, irc_user, channels) for `user`, or the bot's own user"""
+        return await self.query_table("status", "ListNetworks" + (f" {user}" if user else ""))
+
+    async def list_all_networks(self) -> List[tuple]:
+        """Network rows for every ZNC user in a single query"""
+        return await self.query_table("status", "ListAllUserNetworks")
+
+    async def list_clients(self, user: str = None) -> List[tuple]:
+        """Rows of connected clients for `user`, or the bot's own user"""
+        return await self.query_table("status", "ListClients" + (f" {user}" if user else ""))
+
     async def get_user_hosts(self) -> None:
         """Should only be run periodically to keep the user list in sync"""
-        self.get_users_state = 0
-        self.bnc_users.clear()
-        user_list_fut = self.loop.create_future()
-        self.futures["user_list"] = user_list_fut
-        self.send("znc listusers")
-        await user_list_fut
-        del self.futures["user_list"]
-
-        for user in self.bnc_users:
-            bindhost_fut = self.loop.create_future()
-            self.futures["bindhost"] = bindhost_fut
-            self.module_msg("controlpanel", f"Get BindHost {user}")
-            self.bnc_users[user] = await bindhost_fut
-            del self.futures["bindhost"]
-
+        if not self.connected:
+            self.logger.warning("Not connected to ZNC, skipping user list sync")
+            return
+
+        rows = await self.list_users()
+        if not rows:
+            # Never replace the user list with nothing, every bindhost would be up for reuse
+            self.logger.warning("ZNC returned no users, skipping user list sync")
+            return
+
+        self._sync_touched = set()
+        failed = []
+        try:
+            users = UserTable()
+            for row in rows:
+                async with self.account_lock(row.username):
+                    try:
+                        users[row.username] = await self.controlpanel_get("BindHost", row.username)
+                    except (asyncio.TimeoutError, ConnectionError) as e:
+                        # eg. the user was deleted in ZNC after it was listed, keep what we knew about them
+                        self.logger.warning("Unable to get the BindHost for %s: %r", row.username, e)
+                        failed.append(row.username)
+                        if row.username in self.bnc_users:
+                            users[row.username] = self.bnc_users[row.username]
+
+                delay = self.health.sync_delay()
+                if delay:
+                    await asyncio.sleep(delay)
+
+            # Keep the live state of accounts added or deleted since the sync listed them
+            for name in self._sync_touched:
+                if name in self.bnc_users:
+                    users[name] = self.bnc_users[name]
+                elif name in users:
+                    del users[name]
+        finally:
+            self._sync_touched = None
+
+        self.bnc_data['users'] = users
         self.save_data()
         self.load_data()
-        host_map = defaultdict(list)
-        for user, host in self.bnc_users.items():
-            host_map[host].append(user)
-
-        hosts = {
-            host: users
-            for host, users in host_map.items()
-            if host and len(users) > 1
-        }
+        if failed:
+            self.chan_log(
+                f"WARNING: Unable to get the BindHost for {len(failed)} users during sync: {', '.join(failed[:10])}"
+            )
+
+        hosts = self.bnc_users.duplicate_hosts()
         if hosts:
             self.chan_log(
                 "WARNING: Duplicate BindHosts found: {}".format(
@@ -189,17 +323,77 @@ class Conn:
         self._protocol.register('*', self.handle_line)
         await self._protocol.connect()
 
+    def _drop_protocol(self) -> None:
+        proto = self._protocol
+        if proto is None:
+            return
+
+        proto.quit()
+        # The link may be dead, so don't wait for the server to close it
+        if proto._transport:
+            proto._transport.abort()
+
+        proto._pinger.cancel()
+
+    async def reconnect(self) -> None:
+        """Drop the current connection, fail anything waiting on it and reconnect with exponential backoff"""
+        self.reconnecting = True
+        try:
+            self.fail_pending(ConnectionError("Connection to ZNC lost"))
+            delay = RECONNECT_DELAY
+            while not self.stopped_future.done():
+                self._drop_protocol()
+                try:
+                    await asyncio.wait_for(self.connect(), CONNECT_TIMEOUT)
+                except asyncio.TimeoutError:
+                    self.logger.warning("Reconnect attempt timed out, retrying in up to %ds", delay)
+                else:
+                    break
+
+                await asyncio.sleep(random.uniform(delay / 2, delay))
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+        finally:
+            self.reconnecting = False
+            self.health.seen()
+
+    def restore_session(self) -> None:
+        """Rejoin the channels the bot was in before a reconnect"""
+        for chan in self.channels.values():
+            self.send("JOIN", chan)
+
+    def fail_pending(self, exc: Exception) -> None:
+        for fut in self.futures.values():
+            if not fut.done():
+                fut.set_exception(exc)
+
     def close(self) -> None:
         self._protocol.quit()
 
     async def shutdown(self, restart=False):
         self.chan_log("Bot {}...".format("shutting down" if not restart else "restarting"))
         await asyncio.sleep(1)
+        await self.scheduler.shutdown()
+        if self.api:
+            await self.api.stop()
+
+        if self.profiling.running:
+            self.profiling.stop()
+
+        self.znc_saves.flush()
+
+        self.chan_log_writer.flush(force=True)
         self.close()
-        await asyncio.sleep(1, loop=self.loop)
+        self.audit.close()
+        if self.capture:
+            self.capture.close()
+        await asyncio.sleep(1)
         self.stopped_future.set_result(restart)
 
     async def handle_line(self, proto: 'IrcProtocol', line: 'Message') -> None:
+        self.health.seen()
+        if self.capture:
+            self.capture.record(RECEIVED, str(line))
+
         raw_event = irc.make_event(self, line, proto)
         for handler in self.handlers.get('raw', {}).get('', []):
             await self.launch_hook(raw_event, handler)
@@ -222,14 +416,42 @@ class Conn:
         return any(fnmatch(mask.lower(), pat.lower()) for pat in self.admins)
 
     async def is_bnc_admin(self, name) -> bool:
-        lock = self.locks["controlpanel_bncadmin"]
-        async with lock:
-            fut = self.futures.setdefault("bncadmin", self.loop.create_future())
-            self.module_msg("controlpanel", "Get Admin {}".format(name))
-            res = await fut
-            del self.futures["bncadmin"]
+        return await self.controlpanel_get("Admin", name) == "true"
+
+    async def _wait_reply(self, name: str, send: Callable[[], None]):
+        fut = self.futures[name] = self.loop.create_future()
+        send()
+        try:
+            return await asyncio.wait_for(fut, LOOKUP_TIMEOUT)
+        finally:
+            if self.futures.get(name) is fut:
+                del self.futures[name]
+
+    async def controlpanel_get(self, var: str, user: str) -> str:
+        """Get the value of `var` for the ZNC user `user`"""
+        return await self.lookups.do(("cp_get", var.lower(), user.lower()), self._controlpanel_get, var, user)
+
+    async def _controlpanel_get(self, var: str, user: str) -> str:
+        # Replies don't include the user name, so only one lookup per variable can be pending at a time
+        async with self.locks["controlpanel_get_" + var.lower()]:
+            return await self._wait_reply(
+                "cp_get_" + var.lower(), partial(self.module_msg, "controlpanel", f"Get {var} {user}")
+            )
+
+    async def whois_account(self, nick: str) -> str:
+        """Get the services account `nick` is identified to, or an empty string if they aren't identified"""
+        return await self.lookups.do(("whois", nick.lower()), self._whois_account, nick)
+
+    async def _whois_account(self, nick: str) -> str:
+        return await self._wait_reply("whois_acct_" + nick, partial(self.send, "WHOIS", nick))
 
-        return res
+    async def ns_registered_time(self, acct: str) -> str:
+        """Get the registration time NickServ reports for `acct`"""
+        return await self.lookups.do(("ns_info", acct.lower()), self._ns_registered_time, acct)
+
+    async def _ns_registered_time(self, acct: str) -> str:
+        async with self.locks["ns_info"]:
+            return await self._wait_reply("ns_info", partial(self.msg, "NickServ", f"INFO {acct}"))
 
     def add_queue(self, nick: str, registered_time: str) -> None:
         self.bnc_queue[nick] = registered_time
@@ -242,7 +464,20 @@ class Conn:
 
     def chan_log(self, msg: str) -> None:
         if self.log_chan:
-            self.msg(self.log_chan, msg)
+            self.chan_log_writer.write(msg)
+
+    def save_znc_config(self) -> None:
+        """Have ZNC save its config once the current batch of changes is done"""
+        self.znc_saves.request()
+
+    def account_lock(self, *names: str):
+        """Serialize changes to the BNC accounts `names`"""
+        return self.locks.lock(*("acct:" + name.lower() for name in names))
+
+    def touch_account(self, name: str) -> None:
+        """Record a change to `name` so an in-progress user sync doesn't overwrite it"""
+        if self._sync_touched is not None:
+            self._sync_touched.add(name)
 
     def add_user(self, nick: str) -> bool:
         if not util.is_username_valid(nick):
@@ -264,7 +499,7 @@ class Conn:
         self.module_msg('controlpanel', f"Set AltNick {username} {nick}_")
         self.module_msg('controlpanel', f"Set Ident {username} {nick}")
         self.module_msg('controlpanel', f"Set Realname {username} {nick}")
-        self.send('znc saveconfig')
+        self.save_znc_config()
         self.module_msg('controlpanel', f"reconnect {username} Snoonet")
         self.msg(
             "MemoServ",
@@ -273,13 +508,21 @@ class Conn:
             f"/server bnc.snoonet.org 5456 and /PASS {username}:{passwd}"
         )
         self.bnc_users[username] = host
+        self.touch_account(username)
         self.save_data()
         return True
 
+    def del_user(self, acct: str) -> None:
+        self.module_msg('controlpanel', f"deluser {acct}")
+        self.save_znc_config()
+        del self.bnc_users[acct]
+        self.touch_account(acct)
+        self.save_data()
+
     def get_bind_host(self) -> str:
         for _ in range(50):
             host = str(util.get_random_address(self.bind_host_net))
-            if host not in self.bnc_users.values():
+            if not self.bnc_users.has_host(host):
                 return host
         else:
             self.chan_log(
@@ -304,8 +547,12 @@ class Conn:
         return self.bnc_data.setdefault('queue', {})
 
     @property
-    def bnc_users(self) -> Dict[str, str]:
-        return self.bnc_data.setdefault('users', {})
+    def bnc_users(self) -> UserTable:
+        users = self.bnc_data.get('users')
+        if not isinstance(users, UserTable):
+            users = self.bnc_data['users'] = UserTable(users)
+
+        return users
 
     @property
     def prefix(self) -> str:
@@ -335,6 +582,18 @@ class Conn:
     def config_file(self):
         return self.run_dir / "config.json"
 
+    @property
+    def api_socket(self) -> Optional[Path]:
+        path = self.config.get('api_socket')
+        if not path:
+            return None
+
+        return self.run_dir / path
+
+    @property
+    def connected(self) -> bool:
+        return self._protocol is not None and self._protocol.connected and not self.reconnecting
+
     @property
     def nick(self) -> str:
         return self._protocol.nick
@@ -0,0 +1,123 @@
+# coding=utf-8
+"""
+Connection health monitoring: RTT measurement and stall detection
+"""
+import bisect
+import itertools
+import math
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from bncbot.conn import Conn
+
+# Upper bounds, in seconds, of the latency histogram buckets
+RTT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, math.inf)
+
+PING_PREFIX = "bncbot-"
+
+
+def format_secs(secs: float) -> str:
+    if secs == math.inf:
+        return "inf"
+
+    if secs < 1:
+        return f"{secs * 1000:.0f}ms"
+
+    return f"{secs:.1f}s"
+
+
+class LatencyHistogram:
+    """Rolling window of RTT samples"""
+
+    def __init__(self, size: int = 120) -> None:
+        self.samples: Deque[float] = deque(maxlen=size)
+
+    def add(self, rtt: float) -> None:
+        self.samples.append(rtt)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if not self.samples:
+            return None
+
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def buckets(self) -> List[Tuple[float, int]]:
+        counts = [0] * len(RTT_BUCKETS)
+        for rtt in self.samples:
+            counts[bisect.bisect_left(RTT_BUCKETS, rtt)] += 1
+
+        return list(zip(RTT_BUCKETS, counts))
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+
+class HealthMonitor:
+    def __init__(self, conn: 'Conn', stall_timeout: float = 90) -> None:
+        self.conn = conn
+        self.stall_timeout = stall_timeout
+        self.rtt = LatencyHistogram()
+        self.last_line = time.monotonic()
+        self.stalls = 0
+        self._pings: Dict[str, float] = {}
+        self._ping_ids = itertools.count(1)
+
+    def seen(self) -> None:
+        """Called for every line received from ZNC"""
+        self.last_line = time.monotonic()
+
+    @property
+    def idle(self) -> float:
+        return time.monotonic() - self.last_line
+
+    def ping(self) -> None:
+        # Only the most recent ping is tracked, older ones are lost if unanswered
+        token = PING_PREFIX + str(next(self._ping_ids))
+        self._pings = {token: time.monotonic()}
+        self.conn.send(f"PING :{token}")
+
+    def on_pong(self, token: str) -> None:
+        sent = self._pings.pop(token, None)
+        if sent is not None:
+            self.rtt.add(time.monotonic() - sent)
+
+    async def check(self) -> None:
+        """Periodic check: measure RTT, or recover the connection if it has stalled"""
+        if self.conn.reconnecting:
+            return
+
+        if self.idle > self.stall_timeout:
+            self.stalls += 1
+            self.conn.logger.warning("No data received from ZNC in %.0fs, reconnecting", self.idle)
+            await self.conn.reconnect()
+        else:
+            self.ping()
+
+    def sync_delay(self, target: float = 0.25, max_delay: float = 5.0) -> float:
+        """
+        How long to pause between sync queries: nothing while the median RTT is under `target`,
+        otherwise the median RTT, so a slow link isn't flooded
+        """
+        median = self.rtt.percentile(50)
+        if median is None or median < target:
+            return 0.0
+
+        return min(median, max_delay)
+
+    def summary(self) -> str:
+        if not self.rtt:
+            return f"No RTT samples yet (idle {format_secs(self.idle)}, {self.stalls} stalls)"
+
+        out = "RTT last {}, p50 {}, p90 {}, max {} over {} samples (idle {}, {} stalls)".format(
+            format_secs(self.rtt.samples[-1]), format_secs(self.rtt.percentile(50)),
+            format_secs(self.rtt.percentile(90)), format_secs(max(self.rtt.samples)), len(self.rtt),
+            format_secs(self.idle), self.stalls
+        )
+        buckets = ", ".join(
+            (f"<{format_secs(bound)}" if bound != math.inf else f">{format_secs(RTT_BUCKETS[-2])}") + f": {count}"
+            for bound, count in self.rtt.buckets() if count
+        )
+        return f"{out} | {buckets}"
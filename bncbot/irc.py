@@ -18,7 +18,8 @@ CMD_PARAMS = {
 def make_event(conn: 'Conn', line: 'Message', proto: 'IrcProtocol') -> RawEvent:
     cmd = line.command
     params = line.parameters
-    nick = line.prefix.nick
+    prefix = line.prefix
+    nick = prefix.nick if prefix else None
     chan: Optional[str] = None
     if cmd in CMD_PARAMS and 'chan' in CMD_PARAMS[cmd]:
         chan = params[CMD_PARAMS[cmd].index('chan')]
@@ -26,6 +27,7 @@ def make_event(conn: 'Conn', line: 'Message', proto: 'IrcProtocol') -> RawEvent:
             chan = nick
 
     return RawEvent(
-        conn=conn, nick=nick, user=line.prefix.user, host=line.prefix.host, mask=line.prefix.mask, chan=chan,
+        conn=conn, nick=nick, user=prefix and prefix.user, host=prefix and prefix.host,
+        mask=prefix and prefix.mask, chan=chan,
         irc_rawline=line, irc_command=cmd, irc_paramlist=params
     )
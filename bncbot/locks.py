@@ -0,0 +1,90 @@
+# coding=utf-8
+"""
+Per-key asyncio locks which are discarded as soon as they are idle
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List
+
+
+class _Entry:
+    __slots__ = ('lock', 'refs')
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        # Number of tasks holding or waiting on the lock
+        self.refs = 0
+
+
+class KeyedLock:
+    def __init__(self) -> None:
+        self._entries: Dict[str, _Entry] = {}
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __getitem__(self, key: str):
+        return self.lock(key)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def _release(self, key: str, entry: _Entry, held: bool) -> None:
+        if held:
+            entry.lock.release()
+
+        entry.refs -= 1
+        if not entry.refs:
+            del self._entries[key]
+
+    @asynccontextmanager
+    async def lock(self, *keys: str) -> AsyncIterator[None]:
+        """
+        Hold the locks for all of `keys`
+
+        Keys are always acquired in sorted order, so tasks locking overlapping sets of keys can't deadlock
+        """
+        held: List[str] = []
+        try:
+            for key in sorted(set(keys)):
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = self._entries[key] = _Entry()
+
+                entry.refs += 1
+                self.acquisitions += 1
+                contended = entry.lock.locked()
+                start = time.monotonic()
+                try:
+                    await entry.lock.acquire()
+                except BaseException:
+                    self._release(key, entry, False)
+                    raise
+
+                held.append(key)
+                if contended:
+                    wait = time.monotonic() - start
+                    self.contended += 1
+                    self.total_wait += wait
+                    self.max_wait = max(self.max_wait, wait)
+
+            yield
+        finally:
+            for key in reversed(held):
+                self._release(key, self._entries[key], True)
+
+    def waiting(self) -> Dict[str, int]:
+        """Get the number of tasks waiting on each contended key"""
+        return {key: entry.refs - 1 for key, entry in self._entries.items() if entry.refs > 1}
+
+    def summary(self) -> str:
+        avg = self.total_wait / self.contended if self.contended else 0.0
+        pct = 100 * self.contended / self.acquisitions if self.acquisitions else 0.0
+        return "{} active locks, {} acquisitions, {} contended ({:.1f}%), wait avg {:.3f}s max {:.3f}s".format(
+            len(self), self.acquisitions, self.contended, pct, avg, self.max_wait
+        )
@@ -0,0 +1,120 @@
+# coding=utf-8
+"""
+On-demand CPU and memory profiling of the running bot
+
+Nothing is traced until a session is started, so there is no overhead the rest of the time.
+"""
+import asyncio
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+from typing import List, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from bncbot.conn import Conn
+
+# Number of stack frames tracemalloc records for each allocation
+TRACE_FRAMES = 5
+
+# Number of entries included in the written reports
+REPORT_LIMIT = 50
+
+
+def format_size(size: float) -> str:
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+
+        size /= 1024
+
+    return f"{size:.1f} GiB"
+
+
+class ProfileSession:
+    def __init__(self, conn: 'Conn') -> None:
+        self.conn = conn
+        self.started: Optional[float] = None
+        self.duration = 0.0
+        self._profile: Optional[cProfile.Profile] = None
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._started_tracing = False
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def running(self) -> bool:
+        return self.started is not None
+
+    def start(self, duration: float) -> None:
+        """Profile for `duration` seconds, after which the session is stopped and reported automatically"""
+        if self.running:
+            raise ValueError("A profiling session is already running")
+
+        # Don't stop tracing at the end of the session if something else started it
+        self._started_tracing = not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start(TRACE_FRAMES)
+
+        self._snapshot = tracemalloc.take_snapshot()
+        self.started = time.time()
+        self.duration = duration
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        self._handle = self.conn.loop.call_later(duration, self.stop)
+
+    def stop(self) -> List[str]:
+        """Stop the session, write the full reports to the log directory and return a summary"""
+        if not self.running:
+            raise ValueError("No profiling session is running")
+
+        self._profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        if self._started_tracing:
+            tracemalloc.stop()
+
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        elapsed = time.time() - self.started
+        name = time.strftime("profile-%Y%m%d-%H%M%S", time.localtime(self.started))
+        filters = (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        )
+        mem_diff = snapshot.filter_traces(filters).compare_to(self._snapshot.filter_traces(filters), 'lineno')
+        stats = pstats.Stats(self._profile)
+        self._profile = self._snapshot = None
+        self.started = None
+
+        stats.dump_stats(str(self.conn.log_dir / (name + ".prof")))
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats('tottime').print_stats(REPORT_LIMIT)
+        stats.sort_stats('cumulative').print_stats(REPORT_LIMIT)
+        with (self.conn.log_dir / (name + ".txt")).open('w', encoding='utf8') as f:
+            f.write(out.getvalue())
+            f.write("\nMemory allocated during the session, by line:\n")
+            for diff in mem_diff[:REPORT_LIMIT]:
+                f.write(f"{diff}\n")
+
+        summary = [f"Profiled {elapsed:.0f}s, reports written to {name}.txt and {name}.prof"]
+        # (file, line, function) -> (primitive calls, total calls, own time, cumulative time, callers)
+        top = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:5]
+        summary.append("Top CPU: " + ", ".join(
+            f"{func} ({file.rsplit('/', 1)[-1]}:{line}) {tottime * 1000:.1f}ms in {calls} calls"
+            for (file, line, func), (_, calls, tottime, _, _) in top
+        ))
+        growth = [diff for diff in mem_diff if diff.size_diff > 0][:5]
+        if growth:
+            summary.append("Top memory growth: " + ", ".join(
+                f"{diff.traceback[0].filename.rsplit('/', 1)[-1]}:{diff.traceback[0].lineno} "
+                f"+{format_size(diff.size_diff)}"
+                for diff in growth
+            ))
+
+        for line in summary:
+            self.conn.chan_log(line)
+
+        return summary
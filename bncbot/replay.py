@@ -0,0 +1,255 @@
+# coding=utf-8
+"""
+Replay captured traffic (see the "capture_traffic" option) through the bot's handlers offline
+and report the CPU time spent in each handler
+
+Lines the bot received are fed through Conn.handle_line against a stub connection, in a scratch
+directory, so nothing is sent anywhere and the bot's real data files are untouched.
+
+Usage: python -m bncbot.replay [--speed N] [--config config.json] traffic.log.2 traffic.log.1 traffic.log
+
+--speed 1 replays in real time, the default of 0 replays as fast as possible
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import types
+from functools import wraps
+from pathlib import Path
+from typing import Dict, List, Set
+
+from irclib.parser import Message
+
+from bncbot import bot
+from bncbot.capture import read_capture, RECEIVED, SENT
+from bncbot.conn import Conn
+
+# How long to let handlers which are still waiting on replies finish once the capture is exhausted
+DRAIN_TIMEOUT = 1
+
+
+class HandlerStats:
+    __slots__ = ('name', 'calls', 'cpu')
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.calls = 0
+        self.cpu = 0.0
+
+
+class Profiler:
+    """
+    Times each step of the handlers' coroutines, so time spent waiting is excluded
+
+    Handlers called from within other handlers are charged for their own time only
+    """
+
+    def __init__(self) -> None:
+        self.stats: Dict[str, HandlerStats] = {}
+        self._wrapped = {}
+        # [stats, start, time spent in nested handlers] for each handler step in progress
+        self._stack: List[list] = []
+
+    def _step(self, stats: HandlerStats, step, *args):
+        frame = [stats, time.process_time(), 0.0]
+        self._stack.append(frame)
+        try:
+            return step(*args)
+        finally:
+            self._stack.pop()
+            elapsed = time.process_time() - frame[1]
+            stats.cpu += elapsed - frame[2]
+            if self._stack:
+                self._stack[-1][2] += elapsed
+
+    @types.coroutine
+    def _timed(self, stats: HandlerStats, coro):
+        # Drives `coro` the same way `await` would, timing each step
+        value, exc = None, None
+        while True:
+            try:
+                if exc is None:
+                    future = self._step(stats, coro.send, value)
+                else:
+                    future = self._step(stats, coro.throw, exc)
+            except StopIteration as e:
+                return e.value
+
+            try:
+                value, exc = (yield future), None
+            except BaseException as e:
+                value, exc = None, e
+
+    def wrap(self, func):
+        if func in self._wrapped:
+            return self._wrapped[func]
+
+        stats = self.stats[func.__qualname__] = HandlerStats(func.__qualname__)
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args):
+                stats.calls += 1
+                return await self._timed(stats, func(*args))
+        else:
+            # Synchronous handlers are run in an executor thread
+            @wraps(func)
+            def wrapper(*args):
+                stats.calls += 1
+                start = time.thread_time()
+                try:
+                    return func(*args)
+                finally:
+                    stats.cpu += time.thread_time() - start
+
+        self._wrapped[func] = wrapper
+        return wrapper
+
+    def wrap_handlers(self, handlers):
+        return {
+            'raw': {
+                cmd: [self.wrap(func) for func in funcs]
+                for cmd, funcs in handlers.get('raw', {}).items()
+            },
+            'command': {
+                name: cmd._replace(func=self.wrap(cmd.func))
+                for name, cmd in handlers.get('command', {}).items()
+            },
+        }
+
+
+class StubProtocol:
+    """Stands in for the IrcProtocol, counting the lines the bot sends"""
+
+    def __init__(self, nick: str) -> None:
+        self.nick = nick
+        self.connected = True
+        self.sent = 0
+        self._transport = None
+        self._pinger = None
+
+    def send(self, text: str) -> None:
+        self.sent += 1
+
+    def quit(self, reason: str = None) -> None:
+        self.connected = False
+
+
+class ReplayConn(Conn):
+    def __init__(self, handlers, config, nick: str) -> None:
+        super().__init__(handlers)
+        self.config = config
+        self.logger.disabled = True
+        self._protocol = StubProtocol(nick)
+        self.tasks: Set[asyncio.Task] = set()
+
+    def feed(self, line: str) -> None:
+        task = self.loop.create_task(self.handle_line(self._protocol, Message.parse(line)))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+async def replay(conn: ReplayConn, paths: List[Path], speed: float) -> Dict[str, float]:
+    conn.loop = asyncio.get_running_loop()
+    conn.stopped_future = conn.loop.create_future()
+    received = captured_sends = 0
+    first = None
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    for captured in read_capture(paths):
+        if captured.direction == SENT:
+            captured_sends += 1
+            continue
+
+        if captured.direction != RECEIVED:
+            continue
+
+        if speed:
+            if first is None:
+                first = captured.time
+
+            delay = (captured.time - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        conn.feed(captured.line)
+        received += 1
+        if not received % 100:
+            # Let the handlers run so pending tasks don't pile up
+            await asyncio.sleep(0)
+
+    # Handlers still running now are mostly waiting on replies which aren't in the capture,
+    # so the wait for them is reported separately from the replay itself
+    elapsed = time.perf_counter() - start
+    drain_start = time.perf_counter()
+    pending = set()
+    if conn.tasks:
+        _, pending = await asyncio.wait(set(conn.tasks), timeout=DRAIN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    return {
+        'received': received,
+        'captured_sends': captured_sends,
+        'sent': conn._protocol.sent,
+        'elapsed': elapsed,
+        'drain': time.perf_counter() - drain_start,
+        'cancelled': len(pending),
+        'cpu': time.process_time() - cpu_start,
+    }
+
+
+def report(totals: Dict[str, float], profiler: Profiler) -> None:
+    print(
+        f"Replayed {totals['received']} lines in {totals['elapsed']:.3f}s "
+        f"({totals['received'] / totals['elapsed']:,.0f} lines/s), {totals['cpu']:.3f}s CPU"
+    )
+    print(
+        f"Waited {totals['drain']:.3f}s for handlers to finish afterwards, "
+        f"cancelled {totals['cancelled']} still waiting on replies"
+    )
+    print(f"Sent {totals['sent']} lines, {totals['captured_sends']} were sent in the capture")
+    print()
+    print(f"{'handler':<24} {'calls':>8} {'cpu ms':>10} {'us/call':>10}")
+    for stats in sorted(profiler.stats.values(), key=lambda s: s.cpu, reverse=True):
+        if not stats.calls:
+            continue
+
+        print(f"{stats.name:<24} {stats.calls:>8} {stats.cpu * 1000:>10.1f} {stats.cpu * 1e6 / stats.calls:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured IRC traffic through the bot's handlers")
+    parser.add_argument('files', nargs='+', type=Path, help="Capture files, oldest first")
+    parser.add_argument('--speed', type=float, default=0, help="Replay speed relative to real time, 0 for maximum")
+    parser.add_argument('--config', type=Path, help="Bot config to use, otherwise everyone is treated as an admin")
+    parser.add_argument('--nick', default="bnc", help="The bot's nick in the capture")
+    args = parser.parse_args()
+
+    paths = [path.resolve() for path in args.files]
+    if args.config:
+        with args.config.open(encoding='utf8') as f:
+            config = json.load(f)
+    else:
+        config = {'admins': ['*']}
+
+    # Replayed lines must not touch the API socket or the bot's own files
+    config.pop('api_socket', None)
+    profiler = Profiler()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        conn = ReplayConn(profiler.wrap_handlers(bot.HANDLERS), config, args.nick)
+        try:
+            totals = asyncio.run(replay(conn, paths, args.speed))
+        finally:
+            conn.audit.close()
+
+    report(totals, profiler)
+
+
+if __name__ == "__main__":
+    main()
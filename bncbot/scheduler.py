@@ -0,0 +1,141 @@
+# coding=utf-8
+"""
+Named periodic jobs run on the event loop
+"""
+import asyncio
+import random
+import time
+from datetime import timedelta
+from typing import Callable, Dict, Optional, Set, Union, TYPE_CHECKING
+
+from bncbot.async_util import call_func
+
+if TYPE_CHECKING:
+    from logging import Logger
+
+Interval = Union[int, float, timedelta]
+
+
+def _seconds(interval: Interval) -> float:
+    if isinstance(interval, timedelta):
+        return interval.total_seconds()
+
+    return float(interval)
+
+
+class Job:
+    """
+    A periodic job, which will never run concurrently with itself
+    """
+
+    def __init__(self, name: str, interval: Interval, func: Callable, *args,
+                 initial_interval: Interval = None, jitter: Interval = 0) -> None:
+        self.name = name
+        self.func = func
+        self.args = args
+        self.interval = _seconds(interval)
+        self.initial_interval = self.interval if initial_interval is None else _seconds(initial_interval)
+        self.jitter = _seconds(jitter)
+        self.running = False
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        self.last_run: Optional[float] = None
+        self.last_duration: Optional[float] = None
+        self.next_run: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def run(self) -> bool:
+        """Run the job now, returns False if it was skipped because it is already running"""
+        if self.running:
+            self.skipped += 1
+            return False
+
+        self.running = True
+        self.last_run = time.time()
+        start = time.monotonic()
+        try:
+            await call_func(self.func, *self.args)
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self.running = False
+            self.runs += 1
+            self.last_duration = time.monotonic() - start
+
+        return True
+
+
+class Scheduler:
+    def __init__(self, logger: 'Logger') -> None:
+        self.logger = logger
+        self.jobs: Dict[str, Job] = {}
+        self._tasks: Set[asyncio.Future] = set()
+
+    def add(self, name: str, interval: Interval, func: Callable, *args,
+            initial_interval: Interval = None, jitter: Interval = 0) -> Job:
+        """Schedule `func` to be run every `interval`, delayed by up to `jitter` each time"""
+        if name in self.jobs:
+            raise ValueError(f"Job {name!r} is already scheduled")
+
+        job = self.jobs[name] = Job(
+            name, interval, func, *args, initial_interval=initial_interval, jitter=jitter
+        )
+        job.task = self._track(self._schedule(job))
+        return job
+
+    def _track(self, coro) -> asyncio.Future:
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run_logged(self, job: Job) -> None:
+        try:
+            if not await job.run():
+                self.logger.info("Skipping job %s, it is already running", job.name)
+        except Exception:
+            self.logger.exception("Error occurred in job %s", job.name)
+
+    async def _schedule(self, job: Job) -> None:
+        # Runs are scheduled against a fixed start time so they don't drift by the run duration
+        loop = asyncio.get_running_loop()
+        next_run = loop.time() + job.initial_interval
+        while True:
+            job.next_run = next_run + random.uniform(0, job.jitter)
+            await asyncio.sleep(max(0.0, job.next_run - loop.time()))
+            await self._run_logged(job)
+            next_run += job.interval
+            now = loop.time()
+            if next_run < now:
+                missed = int((now - next_run) // job.interval) + 1
+                job.skipped += missed
+                next_run += missed * job.interval
+
+    def is_running(self, name: str) -> bool:
+        return self.jobs[name].running
+
+    async def run_job(self, name: str) -> bool:
+        """Run a job immediately, returns False if it was already running"""
+        # Run as a tracked task so shutdown() cancels it along with the scheduled runs
+        return await self._track(self.jobs[name].run())
+
+    def trigger(self, name: str) -> None:
+        """Start a run of a job in the background"""
+        self._track(self._run_logged(self.jobs[name]))
+
+    def next_run_in(self, job: Job) -> Optional[float]:
+        if job.next_run is None:
+            return None
+
+        return max(0.0, job.next_run - asyncio.get_running_loop().time())
+
+    async def shutdown(self) -> None:
+        """Cancel all scheduled jobs and any runs in progress"""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.jobs.clear()
@@ -0,0 +1,156 @@
+# coding=utf-8
+"""
+Incremental parser for the ASCII tables ZNC modules reply with
+
+    +----------+----------+---------+
+    | Username | Networks | Clients |
+    +==========+==========+=========+
+    | user     | 1        | 0       |
+    +----------+----------+---------+
+"""
+import re
+from collections import namedtuple
+from typing import Callable, Dict, List, Optional, Tuple
+
+BORDER_CHARS = frozenset('+-=')
+
+# Replies ZNC modules send instead of a table when a command fails or has nothing to list.
+# Any other text before the table starts is unrelated output, eg. *status connection notices.
+ERROR_REPLIES = (
+    'Error:',
+    'Usage:',
+    'Access denied',
+    'No such user',
+    'No users',
+    'No networks',
+    'No clients',
+    'You have no networks',
+)
+
+
+def _parse_bool(value: str) -> bool:
+    value = value.lower()
+    if value in ('yes', 'true'):
+        return True
+
+    if value in ('no', 'false'):
+        return False
+
+    raise ValueError(value)
+
+
+# Converters applied to known columns, keyed by normalized column name
+COLUMN_TYPES: Dict[str, Callable[[str], object]] = {
+    'networks': int,
+    'clients': int,
+    'channels': int,
+    'on_irc': _parse_bool,
+}
+
+_row_types: Dict[Tuple[str, ...], type] = {}
+
+
+def normalize_column(name: str) -> str:
+    """Turn a table header like 'IRC Server' in to a field name like 'irc_server'"""
+    return re.sub(r'\W+', '_', name.strip()).strip('_').lower() or 'column'
+
+
+def row_type(columns: Tuple[str, ...]) -> type:
+    """Get the (cached) row record type for a set of table columns"""
+    try:
+        return _row_types[columns]
+    except KeyError:
+        cls = _row_types[columns] = namedtuple('TableRow', columns, rename=True)
+        return cls
+
+
+def convert_cell(column: str, value: str):
+    func = COLUMN_TYPES.get(column)
+    if func is None:
+        return value
+
+    try:
+        return func(value)
+    except ValueError:
+        return value
+
+
+def is_border(line: str) -> bool:
+    return bool(line) and line[0] == '+' and BORDER_CHARS.issuperset(line)
+
+
+def is_error_reply(line: str) -> bool:
+    return line.startswith(ERROR_REPLIES)
+
+
+class TableParser:
+    """
+    Collects a single table from the lines of a module's output
+
+    A module may also reply with an error instead of a table (eg. 'No such user'),
+    in which case the parse is finished with no rows and the message stored in `message`.
+    Other lines before the table starts are ignored.
+
+    Cells are sliced at the column boundaries of the table's borders, since values like nicks may contain '|'
+    """
+
+    def __init__(self) -> None:
+        self.columns: Optional[Tuple[str, ...]] = None
+        self.rows: List[tuple] = []
+        self.message: Optional[str] = None
+        self.done = False
+        # Number of lines fed so far, including ones which aren't part of the table
+        self.lines = 0
+        self._borders = 0
+        self._border = ""
+        self._bounds: List[Tuple[int, int]] = []
+        self._row_type = None
+
+    def _cells(self, line: str) -> Optional[List[str]]:
+        if len(line) == len(self._border):
+            return [line[start:end].strip() for start, end in self._bounds]
+
+        # ZNC pads cells by byte length, so rows with multibyte characters only line up as bytes
+        raw = line.encode()
+        if len(raw) == len(self._border):
+            return [raw[start:end].decode(errors='replace').strip() for start, end in self._bounds]
+
+        cells = line[1:-1].split('|')
+        if len(cells) == len(self._bounds):
+            return [cell.strip() for cell in cells]
+
+        return None
+
+    def feed(self, line: str) -> bool:
+        """Parse a single line of output, returns True once the table is complete"""
+        if self.done:
+            return True
+
+        self.lines += 1
+        line = line.strip()
+        if is_border(line):
+            self._borders += 1
+            if self._borders == 1:
+                self._border = line
+                edges = [i for i, c in enumerate(line) if c == '+']
+                self._bounds = [(start + 1, end) for start, end in zip(edges, edges[1:])]
+            elif self._borders == 3:
+                self.done = True
+        elif self._borders and len(line) > 1 and line[0] == '|' and line[-1] == '|':
+            cells = self._cells(line)
+            if cells is None:
+                # Doesn't fit the table's columns
+                return False
+
+            if self._borders == 1:
+                self.columns = tuple(map(normalize_column, cells))
+                self._row_type = row_type(self.columns)
+            elif self._borders == 2:
+                self.rows.append(self._row_type._make(
+                    convert_cell(column, cell) for column, cell in zip(self.columns, cells)
+                ))
+        elif not self._borders and is_error_reply(line):
+            self.message = line
+            self.done = True
+
+        return self.done
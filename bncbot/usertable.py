@@ -0,0 +1,405 @@
+# coding=utf-8
+"""
+Compact mapping of BNC usernames to bindhosts
+
+Each user occupies a slot: the interned username in a list and the bindhost
+packed in to arrays, so no per-user objects are kept besides the name itself.
+Two arrays of slot numbers, sorted by username (case-insensitively) and by
+bindhost, serve as the name lookup, host -> user reverse index and the prefix
+indexes for searches.
+"""
+import sys
+from array import array
+from fnmatch import fnmatchcase
+from ipaddress import ip_address, IPv4Address, IPv6Address
+from typing import (
+    Callable, Dict, ItemsView, Iterable, Iterator, List, Mapping, MutableMapping, Optional, Tuple, Union, ValuesView
+)
+
+KIND_NONE = 0
+KIND_V4 = 4
+KIND_V6 = 6
+# Bindhosts that aren't IP addresses, which ZNC allows but we never assign
+KIND_OTHER = 1
+
+# Set on IPv6 host keys so they sort after, and never equal, IPv4 ones
+V6_FLAG = 1 << 128
+
+_V6_ZERO = bytes(16)
+
+
+def _bisect_left(index: array, key_at: Callable[[int], object], target) -> int:
+    lo, hi = 0, len(index)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key_at(index[mid]) < target:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    return lo
+
+
+def _literal_prefix(pattern: str) -> str:
+    """The part of a glob pattern before its first wildcard"""
+    for i, c in enumerate(pattern):
+        if c in '*?[':
+            return pattern[:i]
+
+    return pattern
+
+
+def _v4_prefix_ranges(prefix: str) -> List[Tuple[int, int]]:
+    """
+    Get the [start, end) ranges of packed IPv4 addresses whose dotted form starts with `prefix`
+
+    eg. '127.0.1' matches 127.0.1.0/24, 127.0.10.0-127.0.19.255 and 127.0.100.0-127.0.199.255
+    """
+    parts = prefix.split('.')
+    if len(parts) > 4 or not all(part.isdigit() for part in parts[:-1]) or not (parts[-1].isdigit() or not parts[-1]):
+        return []
+
+    octets = [int(part) for part in parts[:-1]]
+    if any(octet > 255 for octet in octets):
+        return []
+
+    base = 0
+    for octet in octets:
+        base = (base << 8) | octet
+
+    shift = 8 * (3 - len(octets))
+    base <<= shift + 8
+    ranges = []
+    for value in range(256):
+        if not str(value).startswith(parts[-1]):
+            continue
+
+        start = base | (value << shift)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], start + (1 << shift))
+        else:
+            ranges.append((start, start + (1 << shift)))
+
+    return ranges
+
+
+def _host_key(host: str) -> Tuple[int, Union[int, str]]:
+    try:
+        addr = ip_address(host)
+    except ValueError:
+        return KIND_OTHER, host
+
+    if isinstance(addr, IPv4Address):
+        return KIND_V4, int(addr)
+
+    return KIND_V6, int(addr) | V6_FLAG
+
+
+class _ItemsView(ItemsView):
+    def __iter__(self):
+        table = self._mapping
+        for slot, name in enumerate(table._names):
+            yield name, table._host_at(slot)
+
+
+class _ValuesView(ValuesView):
+    def __iter__(self):
+        table = self._mapping
+        for slot in range(len(table)):
+            yield table._host_at(slot)
+
+
+class UserTable(MutableMapping[str, Optional[str]]):
+    def __init__(self, data: Union[Mapping[str, Optional[str]], Iterable[Tuple[str, Optional[str]]]] = None) -> None:
+        self.clear()
+        if data:
+            self._load(data.items() if isinstance(data, Mapping) else data)
+
+    def clear(self) -> None:
+        self._names: List[str] = []
+        self._kind = bytearray()
+        self._v4 = array('I')
+        self._v6: Optional[bytearray] = None
+        self._other: Dict[int, str] = {}
+        # Slot numbers sorted by username and by packed bindhost
+        self._by_name = array('I')
+        self._by_host = array('I')
+
+    def _load(self, items: Iterable[Tuple[str, Optional[str]]]) -> None:
+        """Bulk load entries in to an empty table, sorting the indexes once at the end"""
+        for name, host in items:
+            self._new_slot(name, host)
+
+        names = self._names
+        self._by_name = array('I', sorted(range(len(names)), key=self._name_key))
+        self._by_host = array('I', sorted(
+            (slot for slot in range(len(names)) if self._kind[slot] in (KIND_V4, KIND_V6)),
+            key=self._host_key_at
+        ))
+
+    def _host_key_at(self, slot: int) -> Optional[Union[int, str]]:
+        kind = self._kind[slot]
+        if kind == KIND_V4:
+            return self._v4[slot]
+
+        if kind == KIND_V6:
+            return int.from_bytes(self._v6[slot * 16:(slot + 1) * 16], 'big') | V6_FLAG
+
+        if kind == KIND_OTHER:
+            return self._other[slot]
+
+        return None
+
+    @staticmethod
+    def _key_host(key: Union[int, str]) -> str:
+        if isinstance(key, str):
+            return key
+
+        if key & V6_FLAG:
+            return str(IPv6Address(key ^ V6_FLAG))
+
+        return str(IPv4Address(key))
+
+    def _host_at(self, slot: int) -> Optional[str]:
+        key = self._host_key_at(slot)
+        if key is None:
+            return None
+
+        return self._key_host(key)
+
+    def _name_key(self, slot: int) -> Tuple[str, str]:
+        name = self._names[slot]
+        return name.lower(), name
+
+    def _find(self, name: str) -> Optional[int]:
+        pos = _bisect_left(self._by_name, self._name_key, (name.lower(), name))
+        if pos < len(self._by_name) and self._names[self._by_name[pos]] == name:
+            return self._by_name[pos]
+
+        return None
+
+    def _name_pos(self, slot: int) -> int:
+        return _bisect_left(self._by_name, self._name_key, self._name_key(slot))
+
+    def _host_pos(self, slot: int) -> Optional[int]:
+        """Find the position of `slot` in the host index, if it's indexed"""
+        key = self._host_key_at(slot)
+        if key is None or isinstance(key, str):
+            return None
+
+        pos = _bisect_left(self._by_host, self._host_key_at, key)
+        while self._by_host[pos] != slot:
+            pos += 1
+
+        return pos
+
+    def _index_host(self, slot: int) -> None:
+        key = self._host_key_at(slot)
+        if key is not None and not isinstance(key, str):
+            self._by_host.insert(_bisect_left(self._by_host, self._host_key_at, key), slot)
+
+    def _store(self, slot: int, host: Optional[str]) -> None:
+        self._other.pop(slot, None)
+        self._v4[slot] = 0
+        if self._v6 is not None:
+            self._v6[slot * 16:(slot + 1) * 16] = _V6_ZERO
+
+        if not host:
+            self._kind[slot] = KIND_NONE
+            return
+
+        kind, key = _host_key(host)
+        self._kind[slot] = kind
+        if kind == KIND_V4:
+            self._v4[slot] = key
+        elif kind == KIND_V6:
+            if self._v6 is None:
+                self._v6 = bytearray(16 * len(self._names))
+
+            self._v6[slot * 16:(slot + 1) * 16] = (key ^ V6_FLAG).to_bytes(16, 'big')
+        else:
+            self._other[slot] = key
+
+    def _new_slot(self, name: str, host: Optional[str]) -> int:
+        slot = len(self._names)
+        self._names.append(sys.intern(name))
+        self._kind.append(KIND_NONE)
+        self._v4.append(0)
+        if self._v6 is not None:
+            self._v6.extend(_V6_ZERO)
+
+        self._store(slot, host)
+        return slot
+
+    def __setitem__(self, name: str, host: Optional[str]) -> None:
+        slot = self._find(name)
+        if slot is None:
+            slot = self._new_slot(name, host)
+            self._by_name.insert(self._name_pos(slot), slot)
+        else:
+            pos = self._host_pos(slot)
+            if pos is not None:
+                del self._by_host[pos]
+
+            self._store(slot, host)
+
+        self._index_host(slot)
+
+    def __getitem__(self, name: str) -> Optional[str]:
+        slot = self._find(name)
+        if slot is None:
+            raise KeyError(name)
+
+        return self._host_at(slot)
+
+    def __delitem__(self, name: str) -> None:
+        slot = self._find(name)
+        if slot is None:
+            raise KeyError(name)
+
+        del self._by_name[self._name_pos(slot)]
+        pos = self._host_pos(slot)
+        if pos is not None:
+            del self._by_host[pos]
+
+        # Move the last slot in to the one being freed so the arrays stay dense
+        last = len(self._names) - 1
+        if slot != last:
+            self._by_name[self._name_pos(last)] = slot
+            pos = self._host_pos(last)
+            if pos is not None:
+                self._by_host[pos] = slot
+
+            self._names[slot] = self._names[last]
+            self._kind[slot] = self._kind[last]
+            self._v4[slot] = self._v4[last]
+            if self._v6 is not None:
+                self._v6[slot * 16:(slot + 1) * 16] = self._v6[last * 16:]
+
+            self._other.pop(slot, None)
+            if last in self._other:
+                self._other[slot] = self._other.pop(last)
+
+        self._names.pop()
+        self._kind.pop()
+        self._v4.pop()
+        if self._v6 is not None:
+            del self._v6[last * 16:]
+
+        self._other.pop(last, None)
+
+    def __contains__(self, name: object) -> bool:
+        return isinstance(name, str) and self._find(name) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._names)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def items(self) -> ItemsView[str, Optional[str]]:
+        return _ItemsView(self)
+
+    def values(self) -> ValuesView[Optional[str]]:
+        return _ValuesView(self)
+
+    def users_for_host(self, host: str) -> List[str]:
+        """Get the user(s) bound to `host`"""
+        kind, key = _host_key(host)
+        if kind == KIND_OTHER:
+            return [self._names[slot] for slot, other in self._other.items() if other == key]
+
+        users = []
+        pos = _bisect_left(self._by_host, self._host_key_at, key)
+        while pos < len(self._by_host) and self._host_key_at(self._by_host[pos]) == key:
+            users.append(self._names[self._by_host[pos]])
+            pos += 1
+
+        return users
+
+    def find_users(self, pattern: str, limit: int = 50) -> List[str]:
+        """
+        Case-insensitive search for usernames starting with `pattern`, or matching it if it is a glob
+
+        Only the names sharing the pattern's literal prefix are scanned, so a leading wildcard scans everything
+        """
+        pattern = pattern.lower()
+        prefix = _literal_prefix(pattern)
+        is_glob = prefix != pattern
+        users = []
+        for pos in range(_bisect_left(self._by_name, self._name_key, (prefix,)), len(self._by_name)):
+            name = self._names[self._by_name[pos]]
+            lower = name.lower()
+            if not lower.startswith(prefix):
+                break
+
+            if not is_glob or fnmatchcase(lower, pattern):
+                users.append(name)
+                if len(users) >= limit:
+                    break
+
+        return users
+
+    def find_hosts(self, pattern: str, limit: int = 50) -> List[Tuple[str, str]]:
+        """
+        Search for (bindhost, username) pairs where the bindhost starts with `pattern`, or matches it if it is a glob
+
+        IPv4 prefixes are looked up as ranges of the host index, other bindhosts are scanned
+        """
+        pattern = pattern.lower()
+        prefix = _literal_prefix(pattern)
+        is_glob = prefix != pattern
+        ranges = _v4_prefix_ranges(prefix)
+        if ':' in prefix or '.' not in prefix:
+            # IPv6 hosts don't have a usable string prefix ordering, check all of them
+            ranges.append((V6_FLAG, V6_FLAG << 1))
+
+        results = []
+
+        def check(host: str, slot: int) -> bool:
+            if host.startswith(prefix) and (not is_glob or fnmatchcase(host, pattern)):
+                results.append((host, self._names[slot]))
+
+            return len(results) >= limit
+
+        for start, end in ranges:
+            pos = _bisect_left(self._by_host, self._host_key_at, start)
+            while pos < len(self._by_host):
+                slot = self._by_host[pos]
+                key = self._host_key_at(slot)
+                if key >= end:
+                    break
+
+                if check(self._key_host(key), slot):
+                    return results
+
+                pos += 1
+
+        for slot, host in self._other.items():
+            if check(host.lower(), slot):
+                break
+
+        return results
+
+    def has_host(self, host: str) -> bool:
+        return bool(self.users_for_host(host))
+
+    def duplicate_hosts(self) -> Dict[str, List[str]]:
+        """Get all bindhosts which are assigned to more than one user"""
+        groups: Dict[Union[int, str], List[str]] = {}
+        prev = None
+        for slot in self._by_host:
+            key = self._host_key_at(slot)
+            if key == prev:
+                groups.setdefault(key, [self._names[last_slot]]).append(self._names[slot])
+
+            prev, last_slot = key, slot
+
+        for slot, key in self._other.items():
+            groups.setdefault(key, []).append(self._names[slot])
+
+        return {
+            self._key_host(key): users
+            for key, users in groups.items()
+            if len(users) > 1
+        }
@@ -3,8 +3,10 @@ import hashlib
 import random
 import secrets
 import string
+import time
+from collections import deque
 from ipaddress import IPv4Address, IPv6Address, IPv4Network, IPv6Network
-from typing import Union
+from typing import Deque, Dict, Union
 
 VALID_USER_CHARS = string.ascii_letters + string.digits + "-_"
 VALID_USER_START_CHARS = string.ascii_letters
@@ -74,3 +76,40 @@ def sanitize_username(user: str) -> str:
 
 def get_random_address(net: IPNetwork) -> IPAddress:
     return net[random.randrange(net.num_addresses)]
+
+
+class RateLimiter:
+    """
+    Allows each key at most `limit` actions in any `period` seconds
+    """
+
+    def __init__(self, limit: int, period: float) -> None:
+        self.limit = limit
+        self.period = period
+        self._history: Dict[str, Deque[float]] = {}
+        self._last_prune = time.monotonic()
+
+    def allow(self, key: str) -> bool:
+        """Record an action for `key`, returns False if it is over its limit"""
+        now = time.monotonic()
+        if now - self._last_prune > self.period:
+            self.prune(now)
+
+        history = self._history.setdefault(key, deque())
+        while history and now - history[0] >= self.period:
+            history.popleft()
+
+        if len(history) >= self.limit:
+            return False
+
+        history.append(now)
+        return True
+
+    def prune(self, now: float = None) -> None:
+        """Forget keys with no actions in the current period"""
+        if now is None:
+            now = time.monotonic()
+
+        self._last_prune = now
+        for key in [key for key, history in self._history.items() if not history or now - history[-1] >= self.period]:
+            del self._history[key]